@@ -0,0 +1,310 @@
+# loadtest.py
+"""End-to-end load test for main.py against a local fake Telegram Bot API.
+
+Starts an aiohttp stand-in for the Bot API (getUpdates, sendMessage,
+editMessageText, getChatMember, getChat, ...), points the bot at it through
+BOT_API_SERVER and runs the real dispatcher with polling. N simulated
+students then run /quiz, enter their name and answer (or let questions time
+out). Reports p50/p95/p99 latency per handler, memory growth and Bot API
+calls per quiz.
+
+Usage:
+    python loadtest.py --users 1000 --questions 10
+    python loadtest.py --users 200 --max-p95 2.0   # exit code 1 if p95 is above 2 s
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+from aiohttp import web
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def current_rss_mb():
+    """Resident memory of this process in MB"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class FakeBotAPI:
+    """Minimal in-memory Telegram Bot API used by the load test"""
+
+    def __init__(self):
+        self.updates = []
+        self.update_id = 0
+        self.new_updates = asyncio.Event()
+        self.message_id = 0
+        self.call_counts = defaultdict(int)
+        self.chat_waiters = defaultdict(list)  # chat_id -> [(predicate, future)]
+
+    # Update side (what simulated users send to the bot)
+
+    def push_update(self, **event):
+        self.update_id += 1
+        self.updates.append({'update_id': self.update_id, **event})
+        self.new_updates.set()
+
+    def user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f"Student{user_id}", 'username': f"student{user_id}"}
+
+    def send_text(self, user_id, text):
+        self.message_id += 1
+        self.push_update(message={
+            'message_id': self.message_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self.user(user_id),
+            'text': text
+        })
+
+    def press_button(self, user_id, message_id, data):
+        self.push_update(callback_query={
+            'id': f"{user_id}-{self.update_id}",
+            'from': self.user(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'text': '...'
+            }
+        })
+
+    def wait_for_output(self, chat_id, predicate):
+        """Future resolved with the next bot output to chat_id matching predicate"""
+        future = asyncio.get_running_loop().create_future()
+        self.chat_waiters[chat_id].append((predicate, future))
+        return future
+
+    # Bot API side (what the bot calls)
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        self.call_counts[method] += 1
+        params = dict(await request.post())
+        handler = getattr(self, f"api_{method}", None)
+        result = await handler(params) if handler else True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def api_getMe(self, params):
+        return {'id': 1, 'is_bot': True, 'first_name': 'LoadTestBot', 'username': 'loadtest_bot'}
+
+    async def api_getUpdates(self, params):
+        offset = int(params.get('offset', 0))
+        timeout = float(params.get('timeout', 0))
+        self.updates = [update for update in self.updates if update['update_id'] >= offset]
+        if not self.updates and timeout:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:int(params.get('limit', 100))]
+
+    def deliver(self, chat_id, output):
+        waiters = self.chat_waiters.get(chat_id)
+        if not waiters:
+            return
+        for waiter in list(waiters):
+            predicate, future = waiter
+            if future.done():
+                waiters.remove(waiter)
+            elif predicate(output):
+                waiters.remove(waiter)
+                future.set_result(output)
+                break
+
+    def message_result(self, params, message_id):
+        chat_id = int(params['chat_id'])
+        reply_markup = json.loads(params['reply_markup']) if params.get('reply_markup') else None
+        self.deliver(chat_id, {'message_id': message_id, 'text': params.get('text', ''), 'reply_markup': reply_markup})
+        result = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': params.get('text', '')
+        }
+        if reply_markup:
+            result['reply_markup'] = reply_markup
+        return result
+
+    async def api_sendMessage(self, params):
+        self.message_id += 1
+        return self.message_result(params, self.message_id)
+
+    async def api_editMessageText(self, params):
+        return self.message_result(params, int(params['message_id']))
+
+    async def api_getChatMember(self, params):
+        return {'status': 'member', 'user': self.user(int(params['user_id']))}
+
+    async def api_getChat(self, params):
+        chat_id = int(params['chat_id'])
+        return {'id': chat_id, 'type': 'private', 'username': f"student{chat_id}",
+                'accent_color_id': 0, 'max_reaction_count': 11}
+
+
+async def simulate_student(api, user_id, quiz_code, args, latencies, stats):
+    def is_question(output):
+        return bool(output['reply_markup'])
+
+    def is_quiz_message(output):
+        return output['reply_markup'] or output['text'].startswith("🎉")
+
+    started = time.monotonic()
+    reply = api.wait_for_output(user_id, lambda output: True)
+    api.send_text(user_id, f"/quiz {quiz_code}")
+    await reply
+    latencies['quiz_command'].append(time.monotonic() - started)
+
+    started = time.monotonic()
+    question = api.wait_for_output(user_id, is_question)
+    api.send_text(user_id, f"Student {user_id}")
+    output = await question
+    latencies['process_user_name'].append(time.monotonic() - started)
+
+    while output['reply_markup']:
+        next_output = api.wait_for_output(user_id, is_quiz_message)
+        if random.random() < args.timeout_rate:
+            started = time.monotonic()
+            output = await next_output
+            latencies['question_timeout'].append(time.monotonic() - started - args.question_timeout)
+            stats['timeouts'] += 1
+        else:
+            await asyncio.sleep(random.uniform(args.think_min, args.think_max))
+            buttons = output['reply_markup']['inline_keyboard']
+            started = time.monotonic()
+            api.press_button(user_id, output['message_id'], random.choice(buttons)[0]['callback_data'])
+            output = await next_output
+            latencies['handle_quiz_answers'].append(time.monotonic() - started)
+            stats['answers'] += 1
+
+    stats['completed'] += 1
+
+
+async def run(args):
+    api = FakeBotAPI()
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', api.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    # main.py reads its configuration on import
+    workdir = tempfile.mkdtemp(prefix="quiz-loadtest-")
+    os.environ['BOT_API_SERVER'] = f"http://127.0.0.1:{port}"
+    os.environ['FSM_STORAGE'] = args.fsm_storage
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+    main.QUESTION_TIMEOUT = args.question_timeout
+    main.db.path = os.path.join(workdir, "loadtest.db")
+    main.outbound.global_bucket = main.TokenBucket(args.global_rate, args.global_rate)
+    main.db.load()
+
+    quiz_code = main.QuizManager.save_quiz({
+        'name': "Load test",
+        'questions': [
+            {'question': f"Savol {i + 1}?", 'variants': ["A", "B", "C"], 'correct_answer': i % 3}
+            for i in range(args.questions)
+        ],
+        'created_date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'created_by': main.ADMIN_ID
+    })
+
+    polling = asyncio.create_task(main.dp.start_polling(main.bot, handle_signals=False, polling_timeout=1))
+    await asyncio.sleep(0.5)
+
+    latencies = defaultdict(list)
+    stats = defaultdict(int)
+    rss_before = current_rss_mb()
+    calls_before = dict(api.call_counts)
+    started = time.monotonic()
+
+    students = []
+    for user_id in range(1, args.users + 1):
+        students.append(asyncio.create_task(
+            simulate_student(api, 10_000 + user_id, quiz_code, args, latencies, stats)
+        ))
+        if args.ramp_up:
+            await asyncio.sleep(args.ramp_up / args.users)
+    done, pending = await asyncio.wait(students, timeout=args.deadline)
+    for task in pending:
+        task.cancel()
+    failures = [task.exception() for task in done if task.exception()]
+
+    elapsed = time.monotonic() - started
+    rss_after = current_rss_mb()
+    await main.outbound.drain(timeout=10)
+    await main.dp.stop_polling()
+    await polling
+    await main.storage.close()
+    main.db.close()
+    await main.bot.session.close()
+    await runner.cleanup()
+
+    completed = stats['completed'] or 1
+    print(f"\nUsers: {args.users}, questions: {args.questions}, completed: {stats['completed']}, "
+          f"unfinished: {len(pending)}, errors: {len(failures)}")
+    print(f"Answers: {stats['answers']}, timeouts: {stats['timeouts']}, elapsed: {elapsed:.1f}s")
+    print(f"\n{'handler':<22}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for name, values in latencies.items():
+        print(f"{name:<22}{len(values):>8}{percentile(values, 0.5):>10.3f}"
+              f"{percentile(values, 0.95):>10.3f}{percentile(values, 0.99):>10.3f}")
+    print(f"\nMemory: {rss_before:.1f} MB -> {rss_after:.1f} MB (+{rss_after - rss_before:.1f} MB)")
+    print("\nBot API calls per completed quiz:")
+    for method, count in sorted(api.call_counts.items()):
+        calls = count - calls_before.get(method, 0)
+        if calls:
+            print(f"  {method:<22}{calls / completed:>8.2f}")
+
+    failed = bool(pending or failures)
+    if args.max_p95 is not None:
+        worst = max((percentile(values, 0.95) for name, values in latencies.items()
+                     if name != 'question_timeout'), default=0)
+        if worst > args.max_p95:
+            print(f"\nFAIL: p95 latency {worst:.3f}s is above {args.max_p95}s")
+            failed = True
+    return 1 if failed else 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test main.py against a local fake Bot API")
+    parser.add_argument('--users', type=int, default=1000, help="simulated quiz takers")
+    parser.add_argument('--questions', type=int, default=10, help="questions in the quiz")
+    parser.add_argument('--timeout-rate', type=float, default=0.1, help="share of questions left to time out")
+    parser.add_argument('--question-timeout', type=float, default=3.0, help="QUESTION_TIMEOUT used in the test")
+    parser.add_argument('--think-min', type=float, default=1.0, help="min seconds before answering")
+    parser.add_argument('--think-max', type=float, default=2.0, help="max seconds before answering")
+    parser.add_argument('--ramp-up', type=float, default=5.0, help="seconds over which users start")
+    parser.add_argument('--global-rate', type=float, default=1000.0,
+                        help="outbound messages/s allowed (Telegram allows ~30, raise it to measure the bot itself)")
+    parser.add_argument('--fsm-storage', default="sqlite", choices=["sqlite", "memory"])
+    parser.add_argument('--deadline', type=float, default=600.0, help="give up after this many seconds")
+    parser.add_argument('--max-p95', type=float, default=None, help="fail if any handler p95 is above this (s)")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(asyncio.run(run(parse_args())))
@@ -1,16 +1,34 @@
 # main.py
 import asyncio
 import logging
-from aiogram import Bot, Dispatcher, types
+from aiogram import BaseMiddleware, Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import Command
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, FSInputFile
 from aiogram.enums import ChatMemberStatus
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from aiogram.methods import EditMessageText, SendMessage
+from aiohttp import web
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
 from aiogram.fsm.storage.memory import MemoryStorage
+import bisect
+import csv
+import gzip
 import json
+import multiprocessing
+import os
+import queue
+from collections import OrderedDict, deque
 import random
+import sqlite3
 import string
+import tempfile
+import threading
+import time
 from datetime import datetime, timedelta
 import calendar
 
@@ -28,23 +46,262 @@ ADMIN_ID = 7377694590  # Yagona admin ID
 def is_admin(user_id):
     return user_id == ADMIN_ID
 
-# Helper function to check channel membership
-async def check_channel_membership(user_id):
+# Membership cache settings
+MEMBERSHIP_CACHE_TTL = 300  # Seconds to trust a positive membership check
+MEMBERSHIP_NEGATIVE_CACHE_TTL = 30  # Seconds to trust a negative membership check
+MEMBERSHIP_CACHE_MAX_SIZE = 10000  # Least recently checked users are evicted above this size
+membership_cache = OrderedDict()  # user_id -> (is_member, expires_at)
+membership_requests = {}  # user_id -> in-flight get_chat_member task
+
+async def fetch_channel_membership(user_id):
+    """Ask Telegram whether user is a channel member and cache the answer"""
     try:
         member = await bot.get_chat_member(chat_id=REQUIRED_CHANNEL, user_id=user_id)
-        return member.status in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR]
     except Exception as e:
         logging.error(f"Error checking membership for user {user_id}: {e}")
-        return False
+        return False  # Errors are not cached, next call will retry
+    
+    is_member = member.status in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR]
+    if membership_requests.get(user_id) is not asyncio.current_task():
+        return is_member  # Invalidated while we were asking, don't cache a possibly stale answer
+    
+    ttl = MEMBERSHIP_CACHE_TTL if is_member else MEMBERSHIP_NEGATIVE_CACHE_TTL
+    membership_cache[user_id] = (is_member, time.monotonic() + ttl)
+    membership_cache.move_to_end(user_id)
+    while len(membership_cache) > MEMBERSHIP_CACHE_MAX_SIZE:
+        membership_cache.popitem(last=False)
+    return is_member
+
+# Helper function to check channel membership
+async def check_channel_membership(user_id):
+    cached = membership_cache.get(user_id)
+    if cached and cached[1] > time.monotonic():
+        membership_cache.move_to_end(user_id)
+        return cached[0]
+    
+    # Share one in-flight request between concurrent lookups for the same user
+    request = membership_requests.get(user_id)
+    if request is None:
+        request = asyncio.create_task(fetch_channel_membership(user_id))
+        membership_requests[user_id] = request
+        request.add_done_callback(lambda task: forget_membership_request(user_id, task))
+    
+    return await asyncio.shield(request)
+
+def forget_membership_request(user_id, request):
+    if membership_requests.get(user_id) is request:
+        del membership_requests[user_id]
+
+def invalidate_channel_membership(user_id):
+    """Forget cached membership, and any lookup already in flight, so the next check asks Telegram again"""
+    membership_cache.pop(user_id, None)
+    membership_requests.pop(user_id, None)
+
+# Run mode settings ("polling" for development, "webhook" for production)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Public HTTPS base URL, e.g. https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("PORT", "8080"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))  # Worker processes behind the webhook
+DATABASE_SYNC_INTERVAL = 10  # Seconds between pulls of other workers' data
+BOT_API_SERVER = os.getenv("BOT_API_SERVER", "")  # Local Bot API server (or load-test fake) base URL
 
 # Initialize bot and dispatcher
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
+if BOT_API_SERVER:
+    bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(BOT_API_SERVER)))
+else:
+    bot = Bot(token=BOT_TOKEN)
+
+# Outbound rate limits (Telegram allows ~30 messages/s overall,
+# ~1 message/s per private chat and 20 messages/min per group)
+OUTBOUND_GLOBAL_RATE = 30
+OUTBOUND_CHAT_RATE = 1
+OUTBOUND_CHAT_BURST = 3
+OUTBOUND_GROUP_RATE = 20 / 60
+OUTBOUND_WORKERS = 8
+OUTBOUND_MAX_ATTEMPTS = 5  # Attempts per request when Telegram answers RetryAfter
+OUTBOUND_MAX_CHAT_BUCKETS = 10000
+
+# Outbound priorities (lower is sent first)
+PRIORITY_QUESTION = 0  # Question messages and edits a student is waiting for
+PRIORITY_RESULT = 1  # Result messages
+PRIORITY_ADMIN = 2  # Admin notifications
+PRIORITY_BROADCAST = 3  # Broadcasts only use capacity nothing else needs
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def reserve(self):
+        """Take one token and return how many seconds to wait before using it"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+    
+    def pause(self, seconds):
+        """Push every later reservation back by the given time (used for RetryAfter)"""
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+class OutboundJob:
+    __slots__ = ('method', 'chat_id', 'future', 'attempts', 'reserved')
+    
+    def __init__(self, method, future):
+        self.method = method
+        self.chat_id = getattr(method, 'chat_id', None)
+        self.future = future
+        self.attempts = 0
+        self.reserved = False  # Already holds a token of its chat bucket
+
+class OutboundQueue:
+    """Priority queue for Bot API calls with global and per-chat token buckets.
+    
+    Question edits go ahead of result messages, which go ahead of admin
+    notifications. A request whose chat has no tokens left is parked and
+    re-queued later, so it doesn't hold up other chats. RetryAfter answers
+    pause the chat and retry the request.
+    """
+    
+    def __init__(self):
+        self.queue = None
+        self.workers = []
+        self.counter = 0
+        self.parked = 0  # Jobs waiting for their chat bucket or RetryAfter
+        self.global_bucket = TokenBucket(OUTBOUND_GLOBAL_RATE, OUTBOUND_GLOBAL_RATE)
+        self.chat_buckets = OrderedDict()
+    
+    def start(self):
+        if self.queue is None:
+            self.queue = asyncio.PriorityQueue()
+            self.workers = [asyncio.create_task(self.worker()) for _ in range(OUTBOUND_WORKERS)]
+    
+    def put(self, priority, job):
+        self.counter += 1
+        self.queue.put_nowait((priority, self.counter, job))
+    
+    async def send(self, method, priority=PRIORITY_QUESTION):
+        """Send a Bot API method through the queue and wait for its result"""
+        self.start()
+        job = OutboundJob(method, asyncio.get_running_loop().create_future())
+        self.put(priority, job)
+        return await job.future
+    
+    def submit(self, method, priority=PRIORITY_ADMIN):
+        """Queue a Bot API method without waiting; failures are logged"""
+        self.start()
+        self.put(priority, OutboundJob(method, None))
+    
+    async def drain(self, timeout):
+        """Wait (up to timeout seconds) for queued requests to be sent"""
+        if self.queue is None:
+            return
+        
+        async def wait_idle():
+            while True:
+                await self.queue.join()
+                if not self.parked:
+                    return
+                await asyncio.sleep(0.1)
+        
+        try:
+            await asyncio.wait_for(wait_idle(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"{self.queue.qsize() + self.parked} outbound requests were not sent before shutdown")
+    
+    def get_chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST)
+            else:
+                bucket = TokenBucket(OUTBOUND_GROUP_RATE, 1)
+            self.chat_buckets[chat_id] = bucket
+            if len(self.chat_buckets) > OUTBOUND_MAX_CHAT_BUCKETS:
+                self.chat_buckets.popitem(last=False)
+        else:
+            self.chat_buckets.move_to_end(chat_id)
+        return bucket
+    
+    def requeue_later(self, delay, priority, job):
+        self.parked += 1
+        asyncio.get_running_loop().call_later(delay, self.unpark, priority, job)
+    
+    def unpark(self, priority, job):
+        self.parked -= 1
+        self.put(priority, job)
+    
+    async def worker(self):
+        while True:
+            priority, _, job = await self.queue.get()
+            try:
+                await self.process(priority, job)
+            finally:
+                self.queue.task_done()
+    
+    async def process(self, priority, job):
+        chat_bucket = self.get_chat_bucket(job.chat_id) if job.chat_id is not None else None
+        if chat_bucket is not None and not job.reserved:
+            # Reserving up front keeps requests to the same chat in order
+            job.reserved = True
+            delay = chat_bucket.reserve()
+            if delay > 0:
+                self.requeue_later(delay, priority, job)
+                return
+        
+        delay = self.global_bucket.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        
+        job.attempts += 1
+        try:
+            result = await bot(job.method)
+        except TelegramRetryAfter as e:
+            if job.attempts < OUTBOUND_MAX_ATTEMPTS:
+                logging.warning(f"Flood control for chat {job.chat_id}, retrying in {e.retry_after}s")
+                (chat_bucket or self.global_bucket).pause(e.retry_after)
+                self.requeue_later(e.retry_after, priority, job)
+            else:
+                self.fail(job, e)
+        except Exception as e:
+            self.fail(job, e)
+        else:
+            if job.future is not None and not job.future.done():
+                job.future.set_result(result)
+    
+    def fail(self, job, error):
+        if job.future is None:
+            logging.error(f"Failed to send {type(job.method).__name__} to {job.chat_id}: {error}")
+        elif not job.future.done():
+            job.future.set_exception(error)
+
+outbound = OutboundQueue()
 
 # Timer settings
 QUESTION_TIMEOUT = 15  # 15 seconds for each question
-active_timers = {}  # Store active question timers
+TIMER_TICK = 0.25  # Timing wheel resolution in seconds
+TIMER_WHEEL_SIZE = 256  # Timing wheel slots (one turn = 64 seconds)
+active_timers = {}  # Store active question timers (key -> TimerEntry)
+quiz_sessions = {}  # user_id -> QuizSession of users taking a quiz
+timer_wheel = [{} for _ in range(TIMER_WHEEL_SIZE)]  # slot -> {key: TimerEntry}
+
+# Session snapshots (active quizzes survive a restart or deploy)
+SESSION_SNAPSHOT_INTERVAL = 2  # Seconds between snapshots of changed sessions
+session_snapshot_dirty = set()  # user_ids whose session changed since the last snapshot
+
+# Answer code stored in FSM sessions for a question whose timer ran out
+# (answered questions store the selected variant index 0-2)
+ANSWER_TIMEOUT = -1
+ANSWER_LETTERS = "ABC"  # Variant index -> letter shown to users
 
 # States for FSM
 class QuizCreation(StatesGroup):
@@ -58,17 +315,870 @@ class QuizTaking(StatesGroup):
     waiting_for_name = State()
     taking_quiz = State()
 
-# Data storage (in production, use a database)
+class BroadcastCreation(StatesGroup):
+    waiting_for_text = State()
+
+class QuizResult:
+    """One quiz attempt.
+    
+    Answers are packed one byte per question: the selected variant index,
+    or TIMEOUT when time ran out. The attempt time is kept as a Unix
+    timestamp.
+    """
+    __slots__ = ('user_name', 'user_id', 'username', 'score', 'total', 'answers', 'timestamp')
+    TIMEOUT = 255
+    
+    def __init__(self, user_name, user_id, username, score, total, answers, timestamp):
+        self.user_name = user_name
+        self.user_id = user_id
+        self.username = username
+        self.score = score
+        self.total = total
+        self.answers = answers
+        self.timestamp = timestamp
+    
+    @staticmethod
+    def pack_answers(answers):
+        """Pack FSM answer codes (variant index or ANSWER_TIMEOUT) into bytes"""
+        return bytes(QuizResult.TIMEOUT if answer == ANSWER_TIMEOUT else answer for answer in answers)
+    
+    @property
+    def date(self):
+        return datetime.fromtimestamp(self.timestamp).strftime('%Y-%m-%d %H:%M:%S')
+    
+    @property
+    def timeout_count(self):
+        return self.answers.count(QuizResult.TIMEOUT)
+    
+    @property
+    def answered_count(self):
+        return self.total - self.timeout_count
+
+# Data storage (in-memory working set, persisted to SQLite by QuizDatabase)
 quizzes = {}
 quiz_results = {}
+quiz_result_index = {}  # quiz_code -> {user_id: result} for O(1) "already taken" lookups
+question_views = {}  # quiz_code -> (quiz, [(question_text, keyboard), ...]) prebuilt per question
+QUIZ_MISS_CACHE_TTL = 10  # Seconds an unknown quiz code is answered without asking the database
+QUIZ_MISS_CACHE_MAX_SIZE = 10000  # Oldest misses are evicted above this size
+quiz_misses = OrderedDict()  # quiz_code -> expires_at
 users = {}
 bi_weekly_rankings = {}  # Store bi-weekly ranking data
 
+# Database settings
+DATABASE_PATH = "quiz_bot.db"
+DATABASE_BATCH_SIZE = 500  # Max queued writes committed in one transaction
+DATABASE_FLUSH_INTERVAL = 0.5  # Seconds the writer waits to fill a batch
+
+class QuizDatabase:
+    """SQLite (WAL) persistence for quizzes, results, users and rankings.
+    
+    Everything is loaded into the module-level dicts on startup. Writes are
+    queued and committed in batches by a background thread, so handlers never
+    wait for disk I/O.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS quizzes (
+            code TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS quiz_results (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            quiz_code TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            user_name TEXT NOT NULL,
+            username TEXT,
+            score INTEGER NOT NULL,
+            total INTEGER NOT NULL,
+            answers BLOB NOT NULL,
+            date TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_quiz_results_quiz_user ON quiz_results (quiz_code, user_id);
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            username TEXT,
+            last_seen TEXT NOT NULL,
+            updated_seq INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS bi_weekly_rankings (
+            period TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            updated_seq INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (period, user_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_bi_weekly_rankings_period ON bi_weekly_rankings (period);
+        CREATE TABLE IF NOT EXISTS ranking_archives (
+            period TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            users INTEGER NOT NULL,
+            archived_at TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS question_stats (
+            quiz_code TEXT NOT NULL,
+            question INTEGER NOT NULL,
+            picks_a INTEGER NOT NULL DEFAULT 0,
+            picks_b INTEGER NOT NULL DEFAULT 0,
+            picks_c INTEGER NOT NULL DEFAULT 0,
+            timeouts INTEGER NOT NULL DEFAULT 0,
+            correct INTEGER NOT NULL DEFAULT 0,
+            response_time_sum REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (quiz_code, question)
+        );
+        CREATE TABLE IF NOT EXISTS quiz_session_snapshots (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            deadline REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL,
+            cursor INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            elapsed REAL NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS blocked_users (
+            user_id INTEGER PRIMARY KEY,
+            blocked_at TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS fsm_sessions (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL
+        );
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.write_queue = queue.Queue()
+        self.writer_thread = None
+        self.initialized = False  # Schema and WAL mode are set up on first connect
+        # Last rows seen by read_changes
+        self.last_quiz_rowid = 0
+        self.last_result_id = 0
+        self.last_user_seq = -1  # Rows from before updated_seq existed have 0
+        self.last_ranking_seq = -1
+    
+    def connect(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute("PRAGMA synchronous=NORMAL")
+        if not self.initialized:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(self.SCHEMA)
+            self.migrate(connection)
+            self.initialized = True
+        return connection
+    
+    def migrate(self, connection):
+        """Bring databases created by older versions up to SCHEMA"""
+        for table in ("users", "bi_weekly_rankings"):
+            columns = [row[1] for row in connection.execute(f"PRAGMA table_info({table})")]
+            if 'updated_seq' not in columns:
+                connection.execute(f"ALTER TABLE {table} ADD COLUMN updated_seq INTEGER NOT NULL DEFAULT 0")
+            connection.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_seq ON {table} (updated_seq)")
+        connection.commit()
+    
+    def load(self):
+        """Load persisted data into memory and start the writer thread"""
+        self.apply_changes(self.read_changes(BiWeeklyManager.get_active_periods()))
+        logging.info(
+            f"Loaded {len(quizzes)} quizzes, {sum(len(r) for r in quiz_results.values())} results "
+            f"and {len(users)} users from {self.path}"
+        )
+        self.start()
+    
+    def read_changes(self, periods=None):
+        """Read rows added since the last read, including ones written by other processes.
+        
+        Rankings are read for the given periods (all periods if None). User
+        and ranking writes take the next updated_seq of their table, so only
+        rows written since the last read are returned (user ids don't grow
+        over time, so rowid can't be used). Safe to call from a worker thread.
+        """
+        connection = self.connect()
+        try:
+            quiz_rows = connection.execute(
+                "SELECT rowid, code, data FROM quizzes WHERE rowid > ? ORDER BY rowid",
+                (self.last_quiz_rowid,)
+            ).fetchall()
+            result_rows = connection.execute(
+                "SELECT id, quiz_code, user_id, user_name, username, score, total, answers, date "
+                "FROM quiz_results WHERE id > ? ORDER BY id",
+                (self.last_result_id,)
+            ).fetchall()
+            user_rows = connection.execute(
+                "SELECT updated_seq, user_id, name, username, last_seen FROM users "
+                "WHERE updated_seq > ? ORDER BY updated_seq",
+                (self.last_user_seq,)
+            ).fetchall()
+            if periods is None:
+                ranking_rows = connection.execute(
+                    "SELECT updated_seq, period, user_id, data FROM bi_weekly_rankings "
+                    "WHERE updated_seq > ? ORDER BY updated_seq",
+                    (self.last_ranking_seq,)
+                ).fetchall()
+            else:
+                placeholders = ", ".join("?" for _ in periods)
+                ranking_rows = connection.execute(
+                    f"SELECT updated_seq, period, user_id, data FROM bi_weekly_rankings "
+                    f"WHERE updated_seq > ? AND period IN ({placeholders}) ORDER BY updated_seq",
+                    (self.last_ranking_seq, *periods)
+                ).fetchall()
+        finally:
+            connection.close()
+        return quiz_rows, result_rows, user_rows, ranking_rows
+    
+    def apply_changes(self, changes, is_local_user=None):
+        """Merge rows from read_changes into memory.
+        
+        is_local_user(user_id) marks users whose data this process already
+        owns (see webhook workers); their rows are not overwritten.
+        """
+        quiz_rows, result_rows, user_rows, ranking_rows = changes
+        
+        for rowid, code, data in quiz_rows:
+            self.last_quiz_rowid = rowid
+            if code not in quizzes:
+                quizzes[code] = json.loads(data)
+            quiz_misses.pop(code, None)
+        
+        for result_id, quiz_code, user_id, user_name, username, score, total, answers, date in result_rows:
+            self.last_result_id = result_id
+            if is_local_user and is_local_user(user_id):
+                continue
+            if isinstance(answers, str):
+                # Rows written before answers were packed hold a JSON list of answer dicts
+                answers = bytes(
+                    QuizResult.TIMEOUT if answer['timeout'] else answer['selected'] for answer in json.loads(answers)
+                )
+            timestamp = int(datetime.strptime(date, '%Y-%m-%d %H:%M:%S').timestamp())
+            result = QuizResult(user_name, user_id, username, score, total, answers, timestamp)
+            quiz_results.setdefault(quiz_code, []).append(result)
+            quiz_result_index.setdefault(quiz_code, {}).setdefault(user_id, result)
+            results_page_cache.pop(quiz_code, None)
+        
+        for updated_seq, user_id, name, username, last_seen in user_rows:
+            self.last_user_seq = max(self.last_user_seq, updated_seq)
+            if is_local_user and is_local_user(user_id):
+                continue
+            users[user_id] = {'name': name, 'username': username, 'last_seen': last_seen}
+            QuizManager.index_user(user_id)
+        
+        for updated_seq, period, user_id, data in ranking_rows:
+            self.last_ranking_seq = max(self.last_ranking_seq, updated_seq)
+            if is_local_user and is_local_user(user_id):
+                continue
+            user_data = json.loads(data)
+            period_rankings = bi_weekly_rankings.setdefault(period, {})
+            if period_rankings.get(user_id) == user_data:
+                continue  # Unchanged rows must not invalidate cached ranking texts
+            period_rankings[user_id] = user_data
+            ranking_versions[period] = ranking_versions.get(period, 0) + 1
+            if period in bi_weekly_leaderboards:
+                bi_weekly_leaderboards[period].update(user_id, BiWeeklyManager.ranking_sort_key(user_data))
+    
+    def archive_rankings(self, keep_periods, archive_dir):
+        """Move per-attempt detail of finished ranking periods to <period>.jsonl.gz.
+        
+        Rows of archived periods keep a compact per-user summary (totals,
+        average, attempt dates). Periods in keep_periods are left alone.
+        Safe to call from a worker thread; returns [(period, users), ...].
+        """
+        connection = self.connect()
+        archived = []
+        try:
+            periods = [row[0] for row in connection.execute(
+                "SELECT DISTINCT period FROM bi_weekly_rankings "
+                "WHERE period NOT IN (SELECT period FROM ranking_archives)"
+            ).fetchall()]
+            for period in periods:
+                if period in keep_periods:
+                    continue
+                os.makedirs(archive_dir, exist_ok=True)
+                path = os.path.join(archive_dir, f"{period}.jsonl.gz")
+                user_count = 0
+                # Rows are streamed from the cursor, one JSON line per user
+                with gzip.open(path + ".tmp", "wt", encoding="utf-8") as archive:
+                    for user_id, data in connection.execute(
+                        "SELECT user_id, data FROM bi_weekly_rankings WHERE period = ? ORDER BY user_id", (period,)
+                    ):
+                        archive.write(json.dumps({'user_id': user_id, **json.loads(data)}, ensure_ascii=False) + "\n")
+                        user_count += 1
+                os.replace(path + ".tmp", path)
+                with connection:
+                    connection.execute(
+                        "UPDATE bi_weekly_rankings SET data = json_remove(data, '$.quizzes') WHERE period = ?",
+                        (period,)
+                    )
+                    connection.execute(
+                        "INSERT OR REPLACE INTO ranking_archives (period, path, users, archived_at) VALUES (?, ?, ?, ?)",
+                        (period, path, user_count, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+                    )
+                archived.append((period, user_count))
+        finally:
+            connection.close()
+        return archived
+    
+    def start(self):
+        if self.writer_thread is None:
+            self.writer_thread = threading.Thread(target=self.writer_loop, name="quiz-db-writer", daemon=True)
+            self.writer_thread.start()
+    
+    def close(self):
+        """Flush pending writes and stop the writer thread"""
+        if self.writer_thread is not None:
+            self.write_queue.put(None)
+            self.writer_thread.join()
+            self.writer_thread = None
+    
+    def execute(self, sql, params=()):
+        """Queue a write; it is committed later by the writer thread"""
+        self.start()
+        self.write_queue.put((sql, params))
+    
+    def writer_loop(self):
+        connection = self.connect()
+        running = True
+        while running:
+            item = self.write_queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + DATABASE_FLUSH_INTERVAL
+            while len(batch) < DATABASE_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.write_queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+            
+            try:
+                with connection:
+                    for sql, params in batch:
+                        connection.execute(sql, params)
+            except Exception as e:
+                logging.error(f"Failed to write {len(batch)} changes to {self.path}: {e}")
+        connection.close()
+    
+    def fetch_quiz(self, code):
+        """Read one quiz straight from the database (None if missing)"""
+        connection = self.connect()
+        try:
+            row = connection.execute("SELECT data FROM quizzes WHERE code = ?", (code,)).fetchone()
+        finally:
+            connection.close()
+        return json.loads(row[0]) if row else None
+    
+    def fetch_fsm_record(self, key):
+        """Read one FSM session as [state, data] (None if missing)"""
+        connection = self.connect()
+        try:
+            row = connection.execute("SELECT state, data FROM fsm_sessions WHERE key = ?", (key,)).fetchone()
+        finally:
+            connection.close()
+        return [row[0], json.loads(row[1])] if row else None
+    
+    def save_fsm_record(self, key, state, data):
+        if state is None and not data:
+            self.execute("DELETE FROM fsm_sessions WHERE key = ?", (key,))
+        else:
+            self.execute(
+                "INSERT OR REPLACE INTO fsm_sessions (key, state, data) VALUES (?, ?, ?)",
+                (key, state, json.dumps(data, ensure_ascii=False))
+            )
+    
+    def save_quiz(self, code, quiz):
+        self.execute(
+            "INSERT OR REPLACE INTO quizzes (code, data) VALUES (?, ?)",
+            (code, json.dumps(quiz, ensure_ascii=False))
+        )
+    
+    def save_result(self, quiz_code, result):
+        self.execute(
+            "INSERT INTO quiz_results (quiz_code, user_id, user_name, username, score, total, answers, date) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (quiz_code, result.user_id, result.user_name, result.username, result.score,
+             result.total, result.answers, result.date)
+        )
+    
+    def save_user(self, user_id, user_info):
+        # user_id is the rowid, so changes are tracked by updated_seq like rankings
+        self.execute(
+            "INSERT OR REPLACE INTO users (user_id, name, username, last_seen, updated_seq) "
+            "VALUES (?, ?, ?, ?, (SELECT COALESCE(MAX(updated_seq), 0) + 1 FROM users))",
+            (user_id, user_info['name'], user_info['username'], user_info['last_seen'])
+        )
+    
+    def create_broadcast(self, text):
+        """Insert a running broadcast right away and return its id"""
+        connection = self.connect()
+        try:
+            with connection:
+                cursor = connection.execute(
+                    "INSERT INTO broadcasts (text, status, created_at) VALUES (?, 'running', ?)",
+                    (text, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+                )
+        finally:
+            connection.close()
+        return cursor.lastrowid
+    
+    def fetch_running_broadcast(self):
+        """(id, text, cursor, sent, failed, blocked, elapsed) of an unfinished broadcast, or None"""
+        connection = self.connect()
+        try:
+            return connection.execute(
+                "SELECT id, text, cursor, sent, failed, blocked, elapsed FROM broadcasts "
+                "WHERE status = 'running' ORDER BY id LIMIT 1"
+            ).fetchone()
+        finally:
+            connection.close()
+    
+    def save_broadcast_progress(self, broadcast_id, cursor, sent, failed, blocked, elapsed, status="running"):
+        self.execute(
+            "UPDATE broadcasts SET cursor = ?, sent = ?, failed = ?, blocked = ?, elapsed = ?, status = ? WHERE id = ?",
+            (cursor, sent, failed, blocked, elapsed, status, broadcast_id)
+        )
+    
+    def fetch_blocked_users(self):
+        connection = self.connect()
+        try:
+            return {row[0] for row in connection.execute("SELECT user_id FROM blocked_users")}
+        finally:
+            connection.close()
+    
+    def block_user(self, user_id):
+        self.execute(
+            "INSERT OR REPLACE INTO blocked_users (user_id, blocked_at) VALUES (?, ?)",
+            (user_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        )
+    
+    def unblock_user(self, user_id):
+        self.execute("DELETE FROM blocked_users WHERE user_id = ?", (user_id,))
+    
+    def add_question_stats(self, quiz_code, question, picks, timeouts, correct, response_time_sum):
+        """Add to a question's counters (increments, so every worker can write)"""
+        self.execute(
+            "INSERT INTO question_stats (quiz_code, question, picks_a, picks_b, picks_c, timeouts, correct, response_time_sum) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (quiz_code, question) DO UPDATE SET "
+            "picks_a = picks_a + excluded.picks_a, picks_b = picks_b + excluded.picks_b, "
+            "picks_c = picks_c + excluded.picks_c, timeouts = timeouts + excluded.timeouts, "
+            "correct = correct + excluded.correct, response_time_sum = response_time_sum + excluded.response_time_sum",
+            (quiz_code, question, *picks, timeouts, correct, response_time_sum)
+        )
+    
+    def fetch_question_stats(self, quiz_code):
+        """{question: (picks, timeouts, correct, response_time_sum)} for a quiz"""
+        connection = self.connect()
+        try:
+            rows = connection.execute(
+                "SELECT question, picks_a, picks_b, picks_c, timeouts, correct, response_time_sum "
+                "FROM question_stats WHERE quiz_code = ?",
+                (quiz_code,)
+            ).fetchall()
+        finally:
+            connection.close()
+        return {row[0]: ((row[1], row[2], row[3]), row[4], row[5], row[6]) for row in rows}
+    
+    def save_session_snapshot(self, user_id, data, deadline):
+        self.execute(
+            "INSERT OR REPLACE INTO quiz_session_snapshots (user_id, data, deadline) VALUES (?, ?, ?)",
+            (user_id, json.dumps(data, ensure_ascii=False), deadline)
+        )
+    
+    def delete_session_snapshot(self, user_id):
+        self.execute("DELETE FROM quiz_session_snapshots WHERE user_id = ?", (user_id,))
+    
+    def fetch_session_snapshots(self):
+        """[(user_id, data, deadline)] of quiz sessions active at the last snapshot"""
+        connection = self.connect()
+        try:
+            rows = connection.execute("SELECT user_id, data, deadline FROM quiz_session_snapshots").fetchall()
+        finally:
+            connection.close()
+        return [(user_id, json.loads(data), deadline) for user_id, data, deadline in rows]
+    
+    def save_ranking(self, period, user_id, user_data):
+        # The writer holds the write lock, so updated_seq grows in commit order across processes
+        self.execute(
+            "INSERT INTO bi_weekly_rankings (period, user_id, data, updated_seq) "
+            "VALUES (?, ?, ?, (SELECT COALESCE(MAX(updated_seq), 0) + 1 FROM bi_weekly_rankings)) "
+            "ON CONFLICT (period, user_id) DO UPDATE SET data = excluded.data, updated_seq = excluded.updated_seq",
+            (period, user_id, json.dumps(user_data, ensure_ascii=False))
+        )
+
+db = QuizDatabase(DATABASE_PATH)
+
+# FSM storage settings
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")  # "sqlite" (persistent) or "memory"
+FSM_CACHE_SIZE = 10000  # FSM sessions kept in memory
+FSM_FLUSH_INTERVAL = 1.0  # Seconds between batched FSM writes
+
+class SQLiteStorage(BaseStorage):
+    """aiogram FSM storage kept in the bot's SQLite database.
+    
+    Hot sessions live in an in-process LRU cache. Changes are collected and
+    written once per FSM_FLUSH_INTERVAL through the database write queue, so
+    several update_data calls on one session cost a single row write.
+    """
+    
+    def __init__(self, database):
+        self.database = database
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self.cache = OrderedDict()  # key -> [state, data]
+        self.dirty = {}  # key -> [state, data] waiting to be written
+        self.flush_handle = None
+    
+    async def get_record(self, key):
+        record_key = self.key_builder.build(key)
+        record = self.cache.get(record_key)
+        if record is not None:
+            self.cache.move_to_end(record_key)
+            return record_key, record
+        
+        record = self.dirty.get(record_key)
+        if record is None:
+            record = await asyncio.to_thread(self.database.fetch_fsm_record, record_key) or [None, {}]
+        # Another coroutine may have loaded the same key while we were reading
+        record = self.cache.setdefault(record_key, record)
+        while len(self.cache) > FSM_CACHE_SIZE:
+            self.cache.popitem(last=False)  # Dirty records stay in self.dirty until flushed
+        return record_key, record
+    
+    def mark_dirty(self, record_key, record):
+        self.dirty[record_key] = record
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(FSM_FLUSH_INTERVAL, self.flush)
+    
+    def flush(self):
+        """Queue writes for all changed sessions"""
+        self.flush_handle = None
+        dirty, self.dirty = self.dirty, {}
+        for record_key, (state, data) in dirty.items():
+            self.database.save_fsm_record(record_key, state, data)
+    
+    def count_active(self):
+        """Number of cached sessions that are in some state"""
+        return sum(1 for state, _ in self.cache.values() if state is not None)
+    
+    async def set_state(self, key, state=None):
+        record_key, record = await self.get_record(key)
+        record[0] = state.state if isinstance(state, State) else state
+        self.mark_dirty(record_key, record)
+    
+    async def get_state(self, key):
+        _, record = await self.get_record(key)
+        return record[0]
+    
+    async def set_data(self, key, data):
+        record_key, record = await self.get_record(key)
+        record[1] = dict(data)
+        self.mark_dirty(record_key, record)
+    
+    async def get_data(self, key):
+        _, record = await self.get_record(key)
+        return record[1].copy()
+    
+    async def close(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+        self.flush()
+
+# Initialize dispatcher
+storage = SQLiteStorage(db) if FSM_STORAGE == "sqlite" else MemoryStorage()
+dp = Dispatcher(storage=storage)
+
+# Metrics settings (Prometheus text format, served only when METRICS_PORT is set;
+# in webhook mode worker N listens on METRICS_PORT + N)
+METRICS_PORT = os.getenv("METRICS_PORT", "")
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Seconds
+
+class Histogram:
+    __slots__ = ('counts', 'total', 'errors')
+    
+    def __init__(self):
+        self.counts = [0] * (len(METRICS_BUCKETS) + 1)  # Last slot is +Inf
+        self.total = 0.0
+        self.errors = 0
+    
+    def observe(self, seconds, failed=False):
+        self.counts[bisect.bisect_left(METRICS_BUCKETS, seconds)] += 1
+        self.total += seconds
+        if failed:
+            self.errors += 1
+
+class Metrics:
+    handler_latency = {}  # handler name -> Histogram
+    api_latency = {}  # Bot API method -> Histogram
+    
+    @staticmethod
+    def observe(histograms, name, seconds, failed):
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram()
+        histogram.observe(seconds, failed)
+    
+    @staticmethod
+    def count_active_sessions():
+        if isinstance(storage, SQLiteStorage):
+            return storage.count_active()
+        return sum(1 for record in storage.storage.values() if record.state is not None)
+    
+    @staticmethod
+    def render_histograms(lines, metric, label, histograms, help_text):
+        lines.append(f"# HELP {metric}_seconds {help_text}")
+        lines.append(f"# TYPE {metric}_seconds histogram")
+        for name, histogram in sorted(histograms.items()):
+            cumulative = 0
+            for bound, count in zip(METRICS_BUCKETS + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(f'{metric}_seconds_bucket{{{label}="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_seconds_sum{{{label}="{name}"}} {histogram.total:.6f}')
+            lines.append(f'{metric}_seconds_count{{{label}="{name}"}} {cumulative}')
+        lines.append(f"# HELP {metric}_errors_total Calls that raised an exception")
+        lines.append(f"# TYPE {metric}_errors_total counter")
+        for name, histogram in sorted(histograms.items()):
+            lines.append(f'{metric}_errors_total{{{label}="{name}"}} {histogram.errors}')
+    
+    @staticmethod
+    def render():
+        lines = []
+        Metrics.render_histograms(lines, "quizbot_handler", "handler", Metrics.handler_latency,
+                                  "Time spent in update handlers")
+        Metrics.render_histograms(lines, "quizbot_bot_api", "method", Metrics.api_latency,
+                                  "Bot API request latency")
+        gauges = (
+            ("quizbot_active_timers", "Question timers waiting to fire", len(active_timers)),
+            ("quizbot_active_sessions", "FSM sessions in some state", Metrics.count_active_sessions()),
+            ("quizbot_quizzes", "Quizzes loaded in memory", len(quizzes)),
+            ("quizbot_results", "Quiz results loaded in memory", sum(len(results) for results in quiz_results.values())),
+            ("quizbot_outbound_pending", "Bot API calls queued or parked by the rate limiter",
+             (outbound.queue.qsize() if outbound.queue is not None else 0) + outbound.parked),
+        )
+        for metric, help_text, value in gauges:
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+    
+    @staticmethod
+    async def start_server(port):
+        """Serve /metrics on port, returns the runner to clean up on shutdown"""
+        async def handle_metrics(request):
+            return web.Response(text=Metrics.render(), content_type="text/plain", charset="utf-8")
+        
+        app = web.Application()
+        app.router.add_get("/metrics", handle_metrics)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, METRICS_HOST, port).start()
+        logging.info(f"Metrics on http://{METRICS_HOST}:{port}/metrics")
+        return runner
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner middleware timing every handler call by the handler's name"""
+    
+    async def __call__(self, handler, event, data):
+        name = data['handler'].callback.__name__
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = await handler(event, data)
+            failed = False
+            return result
+        finally:
+            Metrics.observe(Metrics.handler_latency, name, time.perf_counter() - started, failed)
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Session middleware timing every Bot API request by method"""
+    
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = await make_request(bot, method)
+            failed = False
+            return result
+        finally:
+            Metrics.observe(Metrics.api_latency, method.__api_method__, time.perf_counter() - started, failed)
+
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+bot.session.middleware(ApiMetricsMiddleware())
+
+# User profile cache (who sent recent updates, so we never ask Telegram via get_chat)
+USER_PROFILE_CACHE_SIZE = 50000  # Least recently seen users are evicted above this
+user_profiles = OrderedDict()  # user_id -> (full_name, username)
+
+def remember_user_profile(user):
+    user_profiles[user.id] = (user.full_name, user.username)
+    user_profiles.move_to_end(user.id)
+    if len(user_profiles) > USER_PROFILE_CACHE_SIZE:
+        user_profiles.popitem(last=False)
+
+def get_user_profile(user_id):
+    """(full_name, username) of a recently seen user, or None"""
+    profile = user_profiles.get(user_id)
+    if profile is not None:
+        user_profiles.move_to_end(user_id)
+    return profile
+
+def get_username(user_id):
+    """Current username from the profile cache, else the one stored with the user's last result"""
+    profile = get_user_profile(user_id)
+    if profile is not None:
+        return profile[1]
+    return users.get(user_id, {}).get('username')
+
+class UserProfileMiddleware(BaseMiddleware):
+    """Outer update middleware remembering the sender of every update"""
+    
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        if user is not None:
+            remember_user_profile(user)
+        return await handler(event, data)
+
+dp.update.outer_middleware(UserProfileMiddleware())
+
+class RankedIndexNode:
+    __slots__ = ('key', 'item_id', 'next', 'width')
+    
+    def __init__(self, key, item_id, level):
+        self.key = key
+        self.item_id = item_id
+        self.next = [None] * level
+        self.width = [1] * level
+
+class RankedIndex:
+    """Sorted items with O(log n) update, rank and positional access.
+    
+    Indexable skip list: every link stores how many items it jumps over, so
+    the position of an item and the item at a position are found while
+    walking down the levels. Items with equal sort keys keep the order in
+    which they were first added.
+    """
+    MAX_LEVEL = 24
+    
+    def __init__(self):
+        self.head = RankedIndexNode(None, None, self.MAX_LEVEL)
+        self.keys = {}  # item_id -> full key stored in the list
+        self.insert_order = {}  # item_id -> tie-breaker assigned on first insert
+        self.counter = 0
+    
+    def __len__(self):
+        return len(self.keys)
+    
+    def __contains__(self, item_id):
+        return item_id in self.keys
+    
+    def find_chain(self, key):
+        """Last node before key on every level, with steps taken on each level"""
+        chain = [None] * self.MAX_LEVEL
+        steps = [0] * self.MAX_LEVEL
+        node = self.head
+        for level in reversed(range(self.MAX_LEVEL)):
+            while node.next[level] is not None and node.next[level].key < key:
+                steps[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+        return chain, steps
+    
+    def update(self, item_id, sort_key):
+        """Insert item or move it to the position of its new sort key"""
+        if item_id in self.keys:
+            self.unlink(self.keys.pop(item_id))
+        else:
+            self.counter += 1
+            self.insert_order[item_id] = self.counter
+        key = (sort_key, self.insert_order[item_id])
+        
+        chain, steps_at_level = self.find_chain(key)
+        level_count = 1
+        while level_count < self.MAX_LEVEL and random.random() < 0.5:
+            level_count += 1
+        
+        node = RankedIndexNode(key, item_id, level_count)
+        steps = 0
+        for level in range(level_count):
+            previous = chain[level]
+            node.next[level] = previous.next[level]
+            previous.next[level] = node
+            node.width[level] = previous.width[level] - steps
+            previous.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in range(level_count, self.MAX_LEVEL):
+            chain[level].width[level] += 1
+        
+        self.keys[item_id] = key
+    
+    def remove(self, item_id):
+        key = self.keys.pop(item_id, None)
+        if key is not None:
+            del self.insert_order[item_id]
+            self.unlink(key)
+    
+    def unlink(self, key):
+        chain, _ = self.find_chain(key)
+        node = chain[0].next[0]
+        for level in range(len(node.next)):
+            previous = chain[level]
+            previous.width[level] += node.width[level] - 1
+            previous.next[level] = node.next[level]
+        for level in range(len(node.next), self.MAX_LEVEL):
+            chain[level].width[level] -= 1
+    
+    def rank(self, item_id):
+        """1-based position of item, or None if it is not indexed"""
+        key = self.keys.get(item_id)
+        if key is None:
+            return None
+        _, steps = self.find_chain(key)
+        return sum(steps) + 1
+    
+    def slice(self, start, stop=None):
+        """Item ids at positions start..stop-1 (0-based), like list slicing"""
+        stop = len(self.keys) if stop is None else min(stop, len(self.keys))
+        if start >= stop:
+            return []
+        
+        node = self.head
+        remaining = start + 1
+        for level in reversed(range(self.MAX_LEVEL)):
+            while node.next[level] is not None and node.width[level] <= remaining:
+                remaining -= node.width[level]
+                node = node.next[level]
+        
+        item_ids = []
+        while node is not None and len(item_ids) < stop - start:
+            item_ids.append(node.item_id)
+            node = node.next[0]
+        return item_ids
+    
+    def top(self, count):
+        return self.slice(0, count)
+
+bi_weekly_leaderboards = {}  # period -> RankedIndex of user_ids
+ranking_versions = {}  # period -> counter bumped on every ranking change (invalidates ranking_text_cache)
+user_directory = RankedIndex()  # user_ids ordered by last_seen, newest first
+
 class BiWeeklyManager:
     @staticmethod
-    def get_current_bi_week():
-        """Get current bi-weekly period"""
-        now = datetime.now()
+    def get_current_bi_week(now=None):
+        """Get current bi-weekly period (or the one containing now)"""
+        now = now or datetime.now()
         year = now.year
         
         # Calculate which bi-week of the year we're in
@@ -92,7 +1202,83 @@ class BiWeeklyManager:
         return bi_week_start, bi_week_end
     
     @staticmethod
-    def update_bi_weekly_ranking(user_id, user_name, username, score, total, quiz_name):
+    def get_previous_bi_week():
+        """Get bi-weekly period before the current one"""
+        current_bi_week = BiWeeklyManager.get_current_bi_week()
+        year, bw_part = current_bi_week.split('-BW')
+        year = int(year)
+        bi_week_num = int(bw_part)
+        
+        if bi_week_num > 1:
+            return f"{year}-BW{bi_week_num-1:02d}"
+        return f"{year-1}-BW26"  # Last bi-week of previous year
+    
+    @staticmethod
+    def get_active_periods():
+        """Periods that are read by the bot: current and previous"""
+        return BiWeeklyManager.get_current_bi_week(), BiWeeklyManager.get_previous_bi_week()
+    
+    @staticmethod
+    def evict_finished_periods():
+        """Keep only the active periods in memory, without per-attempt lists for the previous one"""
+        current_bi_week, prev_bi_week = BiWeeklyManager.get_active_periods()
+        for period in list(bi_weekly_rankings):
+            if period not in (current_bi_week, prev_bi_week):
+                del bi_weekly_rankings[period]
+                bi_weekly_leaderboards.pop(period, None)
+        for key in list(ranking_text_cache):
+            if not set(key[1:]) <= {current_bi_week, prev_bi_week}:
+                del ranking_text_cache[key]
+        for user_data in bi_weekly_rankings.get(prev_bi_week, {}).values():
+            user_data.pop('quizzes', None)
+    
+    @staticmethod
+    def ranking_sort_key(user_data):
+        # Higher average percentage first, then higher total score
+        return (-user_data['average_percentage'], -user_data['total_score'])
+    
+    @staticmethod
+    def get_leaderboard(period):
+        """Get leaderboard for a period, building it from stored rankings if needed"""
+        leaderboard = bi_weekly_leaderboards.get(period)
+        if leaderboard is None:
+            leaderboard = RankedIndex()
+            for user_id, data in bi_weekly_rankings.get(period, {}).items():
+                leaderboard.update(user_id, BiWeeklyManager.ranking_sort_key(data))
+            bi_weekly_leaderboards[period] = leaderboard
+        return leaderboard
+    
+    @staticmethod
+    def build_ranking_entry(user_id, data):
+        return {
+            'user_id': user_id,
+            'name': data['name'],
+            'username': data['username'],
+            'total_score': data['total_score'],
+            'total_questions': data['total_questions'],
+            'quiz_count': data['quiz_count'],
+            'average_percentage': data['average_percentage'],
+            'quizzes': data.get('quizzes', [])  # Archived periods keep only totals
+        }
+    
+    @staticmethod
+    def get_top_users(count, period=None):
+        """Get top users of a period (current by default) in ranking order"""
+        period = period or BiWeeklyManager.get_current_bi_week()
+        period_data = bi_weekly_rankings.get(period, {})
+        return [
+            BiWeeklyManager.build_ranking_entry(user_id, period_data[user_id])
+            for user_id in BiWeeklyManager.get_leaderboard(period).top(count)
+        ]
+    
+    @staticmethod
+    def get_user_position(user_id, period=None):
+        """Get user's 1-based position in a period (current by default), or None"""
+        period = period or BiWeeklyManager.get_current_bi_week()
+        return BiWeeklyManager.get_leaderboard(period).rank(user_id)
+    
+    @staticmethod
+    def update_bi_weekly_ranking(user_id, user_name, username, score, total, quiz_code):
         """Update bi-weekly ranking for a user"""
         current_bi_week = BiWeeklyManager.get_current_bi_week()
         
@@ -116,86 +1302,26 @@ class BiWeeklyManager:
         user_data['total_score'] += score
         user_data['total_questions'] += total
         user_data['quiz_count'] += 1
-        user_data['quizzes'].append({
-            'quiz_name': quiz_name,
-            'score': score,
-            'total': total,
-            'percentage': round((score/total)*100, 1),
-            'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        })
+        # Compact (quiz_code, score, total, timestamp) entry per attempt
+        user_data['quizzes'].append((quiz_code, score, total, int(time.time())))
         user_data['last_attempt'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         user_data['average_percentage'] = round((user_data['total_score']/user_data['total_questions'])*100, 1)
+        BiWeeklyManager.get_leaderboard(current_bi_week).update(user_id, BiWeeklyManager.ranking_sort_key(user_data))
+        ranking_versions[current_bi_week] = ranking_versions.get(current_bi_week, 0) + 1
+        db.save_ranking(current_bi_week, user_id, user_data)
     
     @staticmethod
-    def get_current_bi_weekly_ranking():
-        """Get current bi-weekly ranking sorted by performance"""
-        current_bi_week = BiWeeklyManager.get_current_bi_week()
-        
-        if current_bi_week not in bi_weekly_rankings:
-            return []
-        
-        ranking_data = []
-        for user_id, data in bi_weekly_rankings[current_bi_week].items():
-            ranking_data.append({
-                'user_id': user_id,
-                'name': data['name'],
-                'username': data['username'],
-                'total_score': data['total_score'],
-                'total_questions': data['total_questions'],
-                'quiz_count': data['quiz_count'],
-                'average_percentage': data['average_percentage'],
-                'quizzes': data['quizzes']
-            })
-        
-        # Sort by average percentage (descending), then by total score (descending)
-        ranking_data.sort(key=lambda x: (x['average_percentage'], x['total_score']), reverse=True)
-        return ranking_data
-    
-    @staticmethod
-    def get_previous_bi_weekly_ranking():
-        """Get previous bi-weekly ranking"""
-        current_bi_week = BiWeeklyManager.get_current_bi_week()
-        year, bw_part = current_bi_week.split('-BW')
-        year = int(year)
-        bi_week_num = int(bw_part)
-        
-        if bi_week_num > 1:
-            prev_bi_week = f"{year}-BW{bi_week_num-1:02d}"
-        else:
-            prev_bi_week = f"{year-1}-BW26"  # Last bi-week of previous year
-        
-        if prev_bi_week not in bi_weekly_rankings:
-            return []
-        
-        ranking_data = []
-        for user_id, data in bi_weekly_rankings[prev_bi_week].items():
-            ranking_data.append({
-                'user_id': user_id,
-                'name': data['name'],
-                'username': data['username'],
-                'average_percentage': data['average_percentage'],
-                'total_score': data['total_score'],
-                'quiz_count': data['quiz_count']
-            })
-        
-        ranking_data.sort(key=lambda x: (x['average_percentage'], x['total_score']), reverse=True)
-        return ranking_data
-    
-    @staticmethod
-    def compare_rankings():
+    def compare_rankings(limit=None):
         """Compare current and previous bi-weekly rankings"""
-        current_ranking = BiWeeklyManager.get_current_bi_weekly_ranking()
-        previous_ranking = BiWeeklyManager.get_previous_bi_weekly_ranking()
-        
-        # Create position maps
-        current_positions = {user['user_id']: i+1 for i, user in enumerate(current_ranking)}
-        previous_positions = {user['user_id']: i+1 for i, user in enumerate(previous_ranking)}
+        current_bi_week = BiWeeklyManager.get_current_bi_week()
+        if limit is None:
+            limit = len(bi_weekly_rankings.get(current_bi_week, {}))
+        current_ranking = BiWeeklyManager.get_top_users(limit, current_bi_week)
+        previous_leaderboard = BiWeeklyManager.get_leaderboard(BiWeeklyManager.get_previous_bi_week())
         
         comparison = []
-        for user in current_ranking:
-            user_id = user['user_id']
-            current_pos = current_positions[user_id]
-            previous_pos = previous_positions.get(user_id, None)
+        for current_pos, user in enumerate(current_ranking, 1):
+            previous_pos = previous_leaderboard.rank(user['user_id'])
             
             if previous_pos is None:
                 change = "🆕 Yangi"
@@ -215,174 +1341,742 @@ class BiWeeklyManager:
         
         return comparison
 
+# Bi-weekly rollover settings
+RANKING_ARCHIVE_DIR = os.getenv("RANKING_ARCHIVE_DIR", "ranking_archive")
+RANKING_ROLLOVER_INTERVAL = 3600  # Seconds between rollover runs
+RANKING_ROLLOVER_GRACE = 300  # Seconds after a period ends before it is archived (late writes)
+
+async def ranking_rollover_forever(archive=True):
+    """Archive finished periods and drop them from memory, once per interval"""
+    while True:
+        try:
+            if archive:
+                keep_periods = (
+                    BiWeeklyManager.get_current_bi_week(),
+                    BiWeeklyManager.get_current_bi_week(datetime.now() - timedelta(seconds=RANKING_ROLLOVER_GRACE))
+                )
+                archived = await asyncio.to_thread(db.archive_rankings, keep_periods, RANKING_ARCHIVE_DIR)
+                for period, user_count in archived:
+                    logging.info(f"Archived ranking period {period} ({user_count} users) to {RANKING_ARCHIVE_DIR}")
+            BiWeeklyManager.evict_finished_periods()
+        except Exception as e:
+            logging.error(f"Ranking rollover failed: {e}")
+        await asyncio.sleep(RANKING_ROLLOVER_INTERVAL)
+
+class TimerEntry:
+    __slots__ = ('key', 'slot', 'rounds', 'deadline', 'callback', 'args')
+    
+    def __init__(self, key, slot, rounds, deadline, callback, args):
+        self.key = key
+        self.slot = slot
+        self.rounds = rounds
+        self.deadline = deadline  # Wall-clock time the timer is due
+        self.callback = callback
+        self.args = args
+
 class QuizTimer:
+    """Question timers on a hashed timing wheel driven by one asyncio task.
+    
+    Arming and cancelling only touch one wheel slot, and every timer that
+    expires on the same tick is fired in one batch.
+    """
+    cursor = 0
+    next_tick = None  # Loop time the driver next advances the cursor (None while idle)
+    driver_task = None
+    wakeup = None
+    
     @staticmethod
-    async def start_question_timer(user_id, state: FSMContext):
-        """Start timer for current question"""
-        # Cancel existing timer if any
-        await QuizTimer.cancel_timer(user_id)
+    def schedule(key, delay, callback, *args):
+        """Call callback(*args) after delay seconds (never earlier, at most one
+        tick later), replacing any timer with this key"""
+        QuizTimer.cancel(key)
         
-        # Create new timer
-        timer_task = asyncio.create_task(QuizTimer.question_timeout(user_id, state))
-        active_timers[user_id] = timer_task
+        # The next tick may be only a fraction of TIMER_TICK away, so count from it
+        now = asyncio.get_running_loop().time()
+        driver_running = QuizTimer.driver_task is not None and not QuizTimer.driver_task.done()
+        first_tick = QuizTimer.next_tick if driver_running and QuizTimer.next_tick is not None else now + TIMER_TICK
+        ticks = 1 + max(0, -int(-(delay - (first_tick - now)) // TIMER_TICK))  # Round up to whole ticks
+        slot = (QuizTimer.cursor + ticks) % TIMER_WHEEL_SIZE
+        entry = TimerEntry(key, slot, (ticks - 1) // TIMER_WHEEL_SIZE, time.time() + delay, callback, args)
+        timer_wheel[slot][key] = entry
+        active_timers[key] = entry
         
-        return timer_task
+        if not driver_running:
+            QuizTimer.wakeup = asyncio.Event()
+            QuizTimer.driver_task = asyncio.create_task(QuizTimer.run_wheel())
+        QuizTimer.wakeup.set()
+        return entry
     
     @staticmethod
-    async def cancel_timer(user_id):
-        """Cancel active timer for user"""
-        if user_id in active_timers:
-            timer_task = active_timers[user_id]
-            if not timer_task.done():
-                timer_task.cancel()
-            del active_timers[user_id]
+    def cancel(key):
+        entry = active_timers.pop(key, None)
+        if entry is not None:
+            del timer_wheel[entry.slot][key]
     
     @staticmethod
-    async def question_timeout(user_id, state: FSMContext):
-        """Handle question timeout"""
-        try:
-            await asyncio.sleep(QUESTION_TIMEOUT)
-            
-            # Check if user is still taking quiz
-            current_state = await state.get_state()
-            if current_state == QuizTaking.taking_quiz.state:
-                data = await state.get_data()
-                quiz = data['quiz']
-                current_question = data['current_question']
-                answers = data.get('answers', [])
-                score = data.get('score', 0)
-                
-                # Mark current question as unanswered
-                answers.append({
-                    'question': quiz['questions'][current_question]['question'],
-                    'selected': None,  # No answer selected
-                    'correct': quiz['questions'][current_question]['correct_answer'],
-                    'is_correct': False,
-                    'timeout': True
-                })
-                
-                current_question += 1
-                
-                if current_question < len(quiz['questions']):
-                    # Move to next question
-                    question = quiz['questions'][current_question]
-                    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                        [InlineKeyboardButton(text=f"A) {question['variants'][0]}", callback_data="answer_0")],
-                        [InlineKeyboardButton(text=f"B) {question['variants'][1]}", callback_data="answer_1")],
-                        [InlineKeyboardButton(text=f"C) {question['variants'][2]}", callback_data="answer_2")]
-                    ])
-                    
-                    await bot.edit_message_text(
-                        chat_id=user_id,
-                        message_id=data.get('current_message_id'),
-                        text=f"⏰ Vaqt tugadi! Keyingi savol...\n\n"
-                             f"📝 {current_question + 1}-savol {len(quiz['questions'])} dan:\n"
-                             f"⏳ {QUESTION_TIMEOUT} soniya\n\n"
-                             f"{question['question']}",
-                        reply_markup=keyboard
-                    )
-                    
-                    await state.update_data(
-                        current_question=current_question,
-                        answers=answers,
-                        score=score
-                    )
-                    
-                    # Start timer for next question
-                    await QuizTimer.start_question_timer(user_id, state)
-                else:
-                    # Quiz finished
-                    await QuizTimer.finish_quiz(user_id, state, data, answers, score)
-        
-        except asyncio.CancelledError:
-            # Timer was cancelled, ignore
-            pass
-        except Exception as e:
-            logging.error(f"Timer error for user {user_id}: {e}")
+    def pending_count():
+        """Number of armed timers"""
+        return len(active_timers)
     
     @staticmethod
-    async def finish_quiz(user_id, state: FSMContext, data, answers, score):
-        """Finish quiz and show results"""
-        try:
-            quiz_code = data['quiz_code']
-            user_name = data['user_name']
-            quiz = data['quiz']
-            total_questions = len(quiz['questions'])
+    async def run_wheel():
+        """Advance the wheel one slot per tick and fire expired timers"""
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time() + TIMER_TICK
+        while True:
+            if not active_timers:
+                # Sleep until something is armed instead of ticking idle
+                QuizTimer.next_tick = None
+                QuizTimer.wakeup.clear()
+                await QuizTimer.wakeup.wait()
+                next_tick = loop.time() + TIMER_TICK
+                QuizTimer.next_tick = next_tick
+                continue
             
-            # Get user info
-            try:
-                user_info = await bot.get_chat(user_id)
-                username = user_info.username
-            except:
-                username = None
+            QuizTimer.next_tick = next_tick
+            await asyncio.sleep(max(0, next_tick - loop.time()))
+            next_tick += TIMER_TICK
+            QuizTimer.cursor = (QuizTimer.cursor + 1) % TIMER_WHEEL_SIZE
             
-            # Save result
-            QuizManager.save_result(
-                quiz_code, user_name, user_id, username, score, total_questions, answers
-            )
-            
-            # Calculate statistics
-            answered_count = sum(1 for answer in answers if not answer.get('timeout', False))
-            timeout_count = total_questions - answered_count
-            percentage = round((score/total_questions) * 100, 1)
-            
-            # Show results to user
-            result_text = f"🎉 Test tugatildi!\n\n"
-            result_text += f"👤 Ism: {user_name}\n"
-            result_text += f"📊 Ball: {score}/{total_questions}\n"
-            result_text += f"📈 Foiz: {percentage}%\n"
-            result_text += f"✅ Javob berildi: {answered_count}\n"
-            result_text += f"⏰ Vaqt tugadi: {timeout_count}\n\n"
-            
-            if score == total_questions:
-                result_text += "🏆 Mukammal ball! Tabriklaymiz!"
-            elif score >= total_questions * 0.8:
-                result_text += "🎯 Ajoyib ish! Zo'r natija!"
-            elif score >= total_questions * 0.6:
-                result_text += "👍 Yaxshi ish! Davom eting!"
-            else:
-                result_text += "📚 O'qishni davom ettiring va qayta urinib ko'ring!"
-            
-            result_text += f"\n\n🏆 Ikki haftalik reytingga qo'shildi!"
+            slot = timer_wheel[QuizTimer.cursor]
+            expired = []
+            for key, entry in list(slot.items()):
+                if entry.rounds > 0:
+                    entry.rounds -= 1
+                else:
+                    del slot[key]
+                    del active_timers[key]
+                    expired.append(entry)
             
-            await bot.send_message(user_id, result_text)
+            if expired:
+                asyncio.create_task(QuizTimer.fire(expired))
+    
+    @staticmethod
+    async def fire(expired):
+        results = await asyncio.gather(
+            *(entry.callback(*entry.args) for entry in expired), return_exceptions=True
+        )
+        for entry, result in zip(expired, results):
+            if isinstance(result, Exception):
+                logging.error(f"Timer error for {entry.key}: {result}")
+    
+    @staticmethod
+    async def start_question_timer(user_id, state: FSMContext, question_index=0, delay=None):
+        """Start timer for current question (QUESTION_TIMEOUT unless delay is given)"""
+        return QuizTimer.schedule(
+            user_id, QUESTION_TIMEOUT if delay is None else delay,
+            QuizTimer.question_timeout, user_id, state, question_index
+        )
+    
+    @staticmethod
+    async def question_timeout(user_id, state: FSMContext, question_index):
+        """Handle question timeout"""
+        session = await QuizSession.get(user_id, state)
+        if session is not None:
+            session.post("timeout", question_index)
+
+class QuizSession:
+    """In-memory state of one quiz taker, with a mailbox.
+    
+    Answer taps and timer expiries are posted to the mailbox and applied one
+    at a time, in order, by a short-lived task, so a tap landing as the timer
+    fires can't advance the quiz twice. The FSM data is read once when the
+    session is loaded and written once per question transition.
+    
+    Changed sessions are snapshotted every SESSION_SNAPSHOT_INTERVAL together
+    with their question deadline, and restore() re-arms them after a restart.
+    """
+    __slots__ = ('user_id', 'state', 'quiz_code', 'user_name', 'current_question', 'answers', 'score',
+                 'message_id', 'mailbox', 'task')
+    
+    def __init__(self, user_id, state: FSMContext, data):
+        self.user_id = user_id
+        self.state = state
+        self.quiz_code = data['quiz_code']
+        self.user_name = data['user_name']
+        self.current_question = data.get('current_question', 0)
+        self.answers = data.get('answers', [])
+        self.score = data.get('score', 0)
+        self.message_id = data.get('current_message_id')
+        self.mailbox = deque()  # (kind, question_index, selected, callback, done future)
+        self.task = None
+    
+    @staticmethod
+    async def get(user_id, state: FSMContext):
+        """Active session of a user, loaded from FSM storage if needed (None if not taking a quiz)"""
+        session = quiz_sessions.get(user_id)
+        if session is None:
+            if await state.get_state() != QuizTaking.taking_quiz.state:
+                return None
+            data = await state.get_data()
+            # Another event may have loaded the session while we were reading
+            session = quiz_sessions.setdefault(user_id, QuizSession(user_id, state, data))
+        return session
+    
+    @staticmethod
+    async def start(user_id, state: FSMContext, data):
+        """Register a new session, persist it and arm the first question's timer"""
+        QuizSession.discard(user_id)
+        session = quiz_sessions[user_id] = QuizSession(user_id, state, data)
+        await state.set_state(QuizTaking.taking_quiz)
+        await session.persist()
+        await session.arm_timer()
+        return session
+    
+    @staticmethod
+    def discard(user_id):
+        """Forget a user's session and its timer (quiz cancelled or restarted)"""
+        QuizTimer.cancel(user_id)
+        if quiz_sessions.pop(user_id, None) is not None:
+            session_snapshot_dirty.add(user_id)
+    
+    @staticmethod
+    def snapshot():
+        """Queue writes of sessions changed since the last snapshot"""
+        global session_snapshot_dirty
+        dirty, session_snapshot_dirty = session_snapshot_dirty, set()
+        for user_id in dirty:
+            session = quiz_sessions.get(user_id)
+            timer = active_timers.get(user_id)
+            if session is None:
+                db.delete_session_snapshot(user_id)
+            elif timer is not None:
+                db.save_session_snapshot(user_id, session.to_data(), timer.deadline)
+            # Otherwise the session is between questions and is marked again when its timer is armed
+    
+    @staticmethod
+    async def restore(is_local_user=lambda user_id: True):
+        """Reload snapshotted sessions after a restart and re-arm their timers.
+        
+        Questions whose deadline passed while the bot was down time out now.
+        """
+        restored = expired = 0
+        now = time.time()
+        for user_id, data, deadline in await asyncio.to_thread(db.fetch_session_snapshots):
+            if not is_local_user(user_id) or user_id in quiz_sessions:
+                continue
+            if await QuizManager.get_quiz(data['quiz_code']) is None or QuizManager.has_user_taken_quiz(data['quiz_code'], user_id):
+                db.delete_session_snapshot(user_id)  # Quiz deleted or finished after the snapshot
+                continue
             
-            # Send results to admin
-            current_ranking = BiWeeklyManager.get_current_bi_weekly_ranking()
-            user_position = None
-            for i, user in enumerate(current_ranking, 1):
-                if user['user_id'] == user_id:
-                    user_position = i
-                    break
+            state = dp.fsm.get_context(bot, chat_id=user_id, user_id=user_id)
+            if await state.get_state() == QuizTaking.taking_quiz.state:
+                stored = await state.get_data()
+                if stored.get('quiz_code') == data['quiz_code'] and stored.get('current_question', 0) > data['current_question']:
+                    # Persistent FSM storage saw answers after the snapshot; that question's deadline is unknown
+                    data, deadline = stored, now + QUESTION_TIMEOUT
+            elif isinstance(storage, SQLiteStorage):
+                db.delete_session_snapshot(user_id)  # Left the quiz after the snapshot
+                continue
             
-            admin_text = f"📊 Yangi Test Natijasi!\n\n"
-            admin_text += f"🎯 Test: {quiz['name']}\n"
-            admin_text += f"👤 Talaba: {user_name}\n"
-            if username:
-                admin_text += f"📱 Username: @{username}\n"
+            session = quiz_sessions[user_id] = QuizSession(user_id, state, data)
+            await state.set_state(QuizTaking.taking_quiz)
+            await session.persist()
+            if deadline > now:
+                await session.arm_timer(deadline - now)
+                restored += 1
             else:
-                admin_text += f"📱 Username yo'q\n"
-            admin_text += f"🆔 ID: {user_id}\n"
-            admin_text += f"📊 Ball: {score}/{total_questions} ({percentage}%)\n"
-            admin_text += f"✅ Javob berildi: {answered_count}\n"
-            admin_text += f"⏰ Vaqt tugadi: {timeout_count}\n"
-            admin_text += f"📅 Sana: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
-            
-            if user_position:
-                admin_text += f"\n🏆 Ikki haftalik reytingda: {user_position}-o'rin"
-            
-            # Send to admin
+                session.post("timeout", session.current_question)
+                expired += 1
+        if restored or expired:
+            logging.info(f"Restored {restored} quiz sessions, {expired} timed out while the bot was down")
+    
+    async def arm_timer(self, delay=None):
+        """Start the current question's timer and mark the session for the next snapshot"""
+        await QuizTimer.start_question_timer(self.user_id, self.state, self.current_question, delay)
+        session_snapshot_dirty.add(self.user_id)
+    
+    def is_active(self):
+        return quiz_sessions.get(self.user_id) is self
+    
+    def post(self, kind, question_index, selected=None, callback=None):
+        """Queue an event; returns a future resolved once it has been applied"""
+        done = asyncio.get_running_loop().create_future()
+        self.mailbox.append((kind, question_index, selected, callback, done))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        return done
+    
+    async def run(self):
+        while self.mailbox:
+            kind, question_index, selected, callback, done = self.mailbox.popleft()
             try:
-                await bot.send_message(ADMIN_ID, admin_text)
+                await self.apply(kind, question_index, selected, callback)
             except Exception as e:
-                logging.error(f"Failed to send message to admin {ADMIN_ID}: {e}")
-            
-            # Clean up
-            await QuizTimer.cancel_timer(user_id)
-            await state.clear()
-            
+                logging.error(f"Quiz session error for user {self.user_id}: {e}")
+            if not done.done():
+                done.set_result(None)
+    
+    def to_data(self):
+        return {
+            'quiz_code': self.quiz_code,
+            'user_name': self.user_name,
+            'current_question': self.current_question,
+            'answers': list(self.answers),  # Copy: storages keep the dict until they flush it
+            'score': self.score,
+            'current_message_id': self.message_id
+        }
+    
+    async def persist(self):
+        await self.state.set_data(self.to_data())
+    
+    async def apply(self, kind, question_index, selected, callback):
+        """Apply one answer or timeout; events for another question are stale and ignored"""
+        if not self.is_active() or question_index != self.current_question:
+            return
+        
+        quiz = await QuizManager.get_quiz(self.quiz_code)
+        correct_answer = quiz['questions'][self.current_question]['correct_answer']
+        if kind == "answer":
+            # Cancel the timer since user answered
+            timer = active_timers.get(self.user_id)
+            response_time = QUESTION_TIMEOUT - (timer.deadline - time.time()) if timer else None
+            QuizTimer.cancel(self.user_id)
+            if selected == correct_answer:
+                self.score += 1
+            self.answers.append(selected)
+        else:
+            # Mark current question as unanswered
+            selected, response_time = ANSWER_TIMEOUT, None
+            self.answers.append(ANSWER_TIMEOUT)
+        QuestionStats.record(self.quiz_code, self.current_question, selected, correct_answer, response_time)
+        self.current_question += 1
+        
+        if self.current_question >= len(quiz['questions']):
+            await self.finish(quiz, callback)
+            return
+        
+        # Move to next question
+        question_text, keyboard = QuizManager.get_question_view(self.quiz_code, self.current_question)
+        if kind == "timeout":
+            question_text = f"⏰ Vaqt tugadi! Keyingi savol...\n\n{question_text}"
+        try:
+            await outbound.send(EditMessageText(
+                chat_id=self.user_id,
+                message_id=self.message_id,
+                text=question_text,
+                reply_markup=keyboard
+            ), PRIORITY_QUESTION)
+        except Exception as e:
+            logging.error(f"Error sending question to user {self.user_id}: {e}")
+        
+        if self.is_active():  # The quiz may have been cancelled while the edit was queued
+            await self.persist()
+            # Start timer for next question
+            await self.arm_timer()
+    
+    @staticmethod
+    def build_result_text(user_name, score, total_questions, timeout_count):
+        """Result message shown to a student when their quiz ends"""
+        answered_count = total_questions - timeout_count
+        percentage = round((score/total_questions) * 100, 1)
+        
+        result_text = f"🎉 Test tugatildi!\n\n"
+        result_text += f"👤 Ism: {user_name}\n"
+        result_text += f"📊 Ball: {score}/{total_questions}\n"
+        result_text += f"📈 Foiz: {percentage}%\n"
+        result_text += f"✅ Javob berildi: {answered_count}\n"
+        result_text += f"⏰ Vaqt tugadi: {timeout_count}\n\n"
+        
+        if score == total_questions:
+            result_text += "🏆 Mukammal ball! Tabriklaymiz!"
+        elif score >= total_questions * 0.8:
+            result_text += "🎯 Ajoyib ish! Zo'r natija!"
+        elif score >= total_questions * 0.6:
+            result_text += "👍 Yaxshi ish! Davom eting!"
+        else:
+            result_text += "📚 O'qishni davom ettiring va qayta urinib ko'ring!"
+        
+        result_text += f"\n\n🏆 Ikki haftalik reytingga qo'shildi!"
+        return result_text
+    
+    async def finish(self, quiz, callback=None):
+        """Save the result, show it to the user and notify admin"""
+        QuizSession.discard(self.user_id)
+        await self.state.clear()
+        
+        total_questions = len(quiz['questions'])
+        score = self.score
+        answers = self.answers
+        user_name = self.user_name
+        
+        username = get_username(self.user_id)
+        
+        # Save result
+        QuizManager.save_result(
+            self.quiz_code, user_name, self.user_id, username, score, total_questions, answers
+        )
+        
+        # Calculate statistics
+        timeout_count = answers.count(ANSWER_TIMEOUT)
+        answered_count = total_questions - timeout_count
+        percentage = round((score/total_questions) * 100, 1)
+        
+        # Show results to user
+        result_text = QuizSession.build_result_text(user_name, score, total_questions, timeout_count)
+        
+        if callback is not None:
+            # Answered the last question: the question message turns into the result
+            await outbound.send(callback.message.edit_text(result_text), PRIORITY_RESULT)
+        else:
+            await outbound.send(SendMessage(chat_id=self.user_id, text=result_text), PRIORITY_RESULT)
+        
+        # Send results to admin
+        user_position = BiWeeklyManager.get_user_position(self.user_id)
+        
+        admin_text = f"📊 Yangi Test Natijasi!\n\n"
+        admin_text += f"🎯 Test: {quiz['name']}\n"
+        admin_text += f"👤 Talaba: {user_name}\n"
+        if username:
+            admin_text += f"📱 Username: @{username}\n"
+        else:
+            admin_text += f"📱 Username yo'q\n"
+        admin_text += f"🆔 ID: {self.user_id}\n"
+        admin_text += f"📊 Ball: {score}/{total_questions} ({percentage}%)\n"
+        admin_text += f"✅ Javob berildi: {answered_count}\n"
+        admin_text += f"⏰ Vaqt tugadi: {timeout_count}\n"
+        admin_text += f"📅 Sana: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
+        
+        if user_position:
+            admin_text += f"\n🏆 Ikki haftalik reytingda: {user_position}-o'rin"
+        
+        # Send to admin
+        outbound.submit(SendMessage(chat_id=ADMIN_ID, text=admin_text), PRIORITY_ADMIN)
+
+async def snapshot_sessions_forever():
+    """Periodically snapshot changed quiz sessions"""
+    while True:
+        await asyncio.sleep(SESSION_SNAPSHOT_INTERVAL)
+        try:
+            QuizSession.snapshot()
         except Exception as e:
-            logging.error(f"Error finishing quiz for user {user_id}: {e}")
+            logging.error(f"Session snapshot failed: {e}")
+
+# Live quiz settings (the admin runs one quiz for a whole class at once)
+FAN_OUT_CONCURRENCY = 50  # Bot API calls in flight when messaging many chats
+live_sessions = {}  # quiz_code -> LiveSession
+
+async def fan_out(methods, priority, concurrency=FAN_OUT_CONCURRENCY, on_error=None):
+    """Send Bot API calls from an iterable through the outbound queue with at
+    most `concurrency` in flight; returns (sent, failed).
+    
+    Failures are logged, or passed to on_error(method, exception) if given.
+    """
+    iterator = iter(methods)
+    counts = [0, 0]
+    
+    async def worker():
+        for method in iterator:
+            try:
+                await outbound.send(method, priority)
+                counts[0] += 1
+            except Exception as e:
+                counts[1] += 1
+                if on_error is not None:
+                    on_error(method, e)
+                else:
+                    logging.error(f"Error sending {method.__api_method__} to {method.chat_id}: {e}")
+    
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return counts[0], counts[1]
+
+class LiveSession:
+    """A quiz every participant takes in lockstep.
+    
+    The admin opens a session, students join with /join <code>, and when the
+    admin starts it everyone gets question N together. One session-wide timer
+    advances all participants; answers are tallied in memory and results go
+    through QuizManager.save_result (and so the bi-weekly ranking) at the end.
+    
+    In webhook mode all live updates are routed to the admin's worker, and
+    each result is handed to the worker that owns the participant, so a
+    user's results and ranking are still only written by one process.
+    """
+    worker_queues = None  # Webhook workers' update queues (None when polling)
+    worker_index = 0
+    
+    def __init__(self, quiz_code, quiz):
+        self.quiz_code = quiz_code
+        self.quiz = quiz
+        self.total = len(quiz['questions'])
+        self.participants = {}  # user_id -> (name, username)
+        self.answers = {}  # user_id -> bytearray of answer codes (QuizResult.TIMEOUT until answered)
+        self.scores = {}  # user_id -> correct answers so far
+        self.tallies = []  # Per question: answers per variant
+        self.response_time_sum = 0.0  # Of answers to the open question
+        self.question_sent_at = 0.0  # Monotonic time the open question started going out
+        self.current_question = -1
+        self.started = False
+        self.closed = False
+        self.task = None  # Runs the questions once started
+        self.views = [self.build_view(i, question) for i, question in enumerate(quiz['questions'])]
+    
+    def build_view(self, index, question):
+        text = (
+            f"📡 Jonli test: {self.quiz['name']}\n\n"
+            f"📝 {index + 1}-savol {self.total} dan:\n"
+            f"⏳ {QUESTION_TIMEOUT} soniya\n\n"
+            f"{question['question']}"
+        )
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text=f"{letter}) {question['variants'][variant]}",
+                                  callback_data=f"live_answer_{self.quiz_code}_{index}_{variant}")]
+            for variant, letter in enumerate(ANSWER_LETTERS)
+        ])
+        return text, keyboard
+    
+    @staticmethod
+    def save_result(quiz_code, user_name, user_id, username, score, total, answers):
+        """Save a live result in the process that owns the user"""
+        queues = LiveSession.worker_queues
+        if queues is not None and user_id % len(queues) != LiveSession.worker_index:
+            queues[user_id % len(queues)].put(json.dumps(
+                {'live_result': [quiz_code, user_name, user_id, username, score, total, answers]}
+            ))
+        elif not QuizManager.has_user_taken_quiz(quiz_code, user_id):
+            QuizManager.save_result(quiz_code, user_name, user_id, username, score, total, answers)
+    
+    @property
+    def timer_key(self):
+        return f"live:{self.quiz_code}"
+    
+    def join(self, user):
+        """Add a participant; returns an error message or None"""
+        if user.id in self.participants:
+            return None
+        if self.started:
+            return "❌ Jonli test allaqachon boshlangan."
+        if QuizManager.has_user_taken_quiz(self.quiz_code, user.id):
+            return "❌ Siz bu testni allaqachon topshirgansiz!"
+        self.participants[user.id] = (user.full_name, user.username)
+        self.answers[user.id] = bytearray([QuizResult.TIMEOUT]) * self.total
+        self.scores[user.id] = 0
+        return None
+    
+    def record_answer(self, user_id, question_index, selected):
+        """Store an answer for the open question; returns False if it is late or repeated"""
+        answers = self.answers.get(user_id)
+        if (answers is None or self.closed or question_index != self.current_question
+                or answers[question_index] != QuizResult.TIMEOUT):
+            return False
+        answers[question_index] = selected
+        self.tallies[question_index][selected] += 1
+        self.response_time_sum += time.monotonic() - self.question_sent_at
+        if selected == self.quiz['questions'][question_index]['correct_answer']:
+            self.scores[user_id] += 1
+        return True
+    
+    async def start(self):
+        if self.started:
+            return
+        self.started = True
+        await self.next_question()
+    
+    async def next_question(self):
+        """Close the open question, then send the next one to everyone (or finish)"""
+        if self.current_question >= 0:
+            self.record_question_stats(self.current_question)
+            outbound.submit(SendMessage(chat_id=ADMIN_ID, text=self.question_summary(self.current_question)), PRIORITY_ADMIN)
+        self.current_question += 1
+        if self.current_question >= self.total:
+            await self.finish()
+            return
+        
+        self.tallies.append([0] * len(ANSWER_LETTERS))
+        self.response_time_sum = 0.0
+        question_text, keyboard = self.views[self.current_question]
+        started = self.question_sent_at = time.monotonic()
+        sent, failed = await fan_out(
+            (SendMessage(chat_id=user_id, text=question_text, reply_markup=keyboard) for user_id in list(self.participants)),
+            PRIORITY_QUESTION
+        )
+        logging.info(
+            f"Live {self.quiz_code} question {self.current_question + 1}: sent to {sent} chats "
+            f"({failed} failed) in {time.monotonic() - started:.1f}s"
+        )
+        if not self.closed:
+            # The shared timer starts once everyone has the question
+            QuizTimer.schedule(self.timer_key, QUESTION_TIMEOUT, self.question_timeout, self.current_question)
+    
+    async def question_timeout(self, question_index):
+        if not self.closed and question_index == self.current_question:
+            await self.next_question()
+    
+    def record_question_stats(self, index):
+        """Add a closed question's tally to the question analytics counters in one write"""
+        tally = self.tallies[index]
+        correct = tally[self.quiz['questions'][index]['correct_answer']]
+        db.add_question_stats(
+            self.quiz_code, index, tally, len(self.participants) - sum(tally), correct, self.response_time_sum
+        )
+    
+    def question_summary(self, index):
+        tally = self.tallies[index]
+        correct = self.quiz['questions'][index]['correct_answer']
+        unanswered = len(self.participants) - sum(tally)
+        variants = " | ".join(f"{letter}: {count}" for letter, count in zip(ANSWER_LETTERS, tally))
+        return (
+            f"📊 {index + 1}-savol yakunlandi ({self.quiz['name']})\n"
+            f"✅ To'g'ri ({ANSWER_LETTERS[correct]}): {tally[correct]}/{len(self.participants)}\n"
+            f"{variants} | ⏰ Javobsiz: {unanswered}"
+        )
+    
+    async def finish(self):
+        """Save every participant's result, send results and a summary to admin"""
+        self.close()
+        messages = []
+        for user_id, (name, username) in self.participants.items():
+            answers = [ANSWER_TIMEOUT if answer == QuizResult.TIMEOUT else answer for answer in self.answers[user_id]]
+            score = self.scores[user_id]
+            LiveSession.save_result(self.quiz_code, name, user_id, username, score, self.total, answers)
+            messages.append(SendMessage(
+                chat_id=user_id,
+                text=QuizSession.build_result_text(name, score, self.total, answers.count(ANSWER_TIMEOUT))
+            ))
+        
+        ranking = sorted(self.participants, key=lambda user_id: -self.scores[user_id])
+        average = sum(self.scores.values()) / (len(self.scores) * self.total) * 100 if self.scores else 0
+        summary = f"🏁 Jonli test yakunlandi: {self.quiz['name']}\n"
+        summary += f"👥 Qatnashchilar: {len(self.participants)}\n"
+        summary += f"📈 O'rtacha natija: {round(average, 1)}%\n"
+        if ranking:
+            summary += "\n🏆 Eng yaxshi natijalar:\n"
+            for i, user_id in enumerate(ranking[:10], 1):
+                medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
+                summary += f"{medal} {self.participants[user_id][0]} - {self.scores[user_id]}/{self.total}\n"
+        outbound.submit(SendMessage(chat_id=ADMIN_ID, text=summary), PRIORITY_ADMIN)
+        await fan_out(messages, PRIORITY_RESULT)
+    
+    def close(self):
+        self.closed = True
+        QuizTimer.cancel(self.timer_key)
+        if live_sessions.get(self.quiz_code) is self:
+            del live_sessions[self.quiz_code]
+    
+    async def cancel(self):
+        self.close()
+        await fan_out(
+            (SendMessage(chat_id=user_id, text="❌ Jonli test bekor qilindi.") for user_id in list(self.participants)),
+            PRIORITY_RESULT
+        )
+    
+    def lobby_text(self):
+        status = "▶️ Davom etmoqda" if self.started else "⏳ Qatnashchilar kutilmoqda"
+        return (
+            f"📡 Jonli test: {self.quiz['name']}\n"
+            f"🔑 Kod: {self.quiz_code}\n"
+            f"❓ Savollar: {self.total}\n"
+            f"{status}\n\n"
+            f"Talabalar qo'shilishi uchun:\n/join {self.quiz_code}\n\n"
+            f"👥 Qatnashchilar: {len(self.participants)}"
+        )
+    
+    def lobby_keyboard(self):
+        keyboard = []
+        if not self.started:
+            keyboard.append([InlineKeyboardButton(text="▶️ Boshlash", callback_data=f"live_start_{self.quiz_code}")])
+        keyboard.append([InlineKeyboardButton(text="🔄 Yangilash", callback_data=f"live_open_{self.quiz_code}")])
+        keyboard.append([InlineKeyboardButton(text="❌ Bekor qilish", callback_data=f"live_stop_{self.quiz_code}")])
+        return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+# Broadcast settings (admin message to every known user)
+BROADCAST_CONCURRENCY = 20  # Messages in flight; the outbound global bucket caps the rate
+BROADCAST_BATCH_SIZE = 100  # Progress is saved after every batch
+
+class Broadcast:
+    """Admin broadcast to everyone in users, resumable after a restart.
+    
+    Recipients are sent in user_id order, in batches. After each batch the
+    last user_id and the counters are saved to the broadcasts table, so a
+    restart resumes from the next batch (at most one batch is re-sent).
+    Users who blocked the bot are recorded in blocked_users and skipped by
+    later broadcasts until they press /start again.
+    """
+    task = None
+    
+    @staticmethod
+    def is_running():
+        return Broadcast.task is not None and not Broadcast.task.done()
+    
+    @staticmethod
+    async def begin(text):
+        broadcast_id = await asyncio.to_thread(db.create_broadcast, text)
+        Broadcast.task = asyncio.create_task(Broadcast.run(broadcast_id, text))
+    
+    @staticmethod
+    async def resume():
+        """Continue a broadcast interrupted by a restart, if there is one"""
+        row = await asyncio.to_thread(db.fetch_running_broadcast)
+        if row is not None and not Broadcast.is_running():
+            logging.info(f"Resuming broadcast {row[0]} after user {row[2]}")
+            Broadcast.task = asyncio.create_task(Broadcast.run(*row))
+    
+    @staticmethod
+    def stop():
+        if Broadcast.is_running():
+            Broadcast.task.cancel()
+    
+    @staticmethod
+    def progress_text(sent, failed, blocked, total, elapsed, finished=False):
+        done = sent + failed + blocked
+        rate = sent / elapsed if elapsed else 0
+        text = "📢 Xabar yuborildi!\n\n" if finished else f"📢 Xabar yuborilmoqda... {done}/{total}\n\n"
+        text += f"✅ Yuborildi: {sent}\n"
+        text += f"❌ Xato: {failed}\n"
+        text += f"🚫 Botni bloklagan: {blocked}\n"
+        text += f"⚡ Tezlik: {rate:.1f} xabar/soniya"
+        if finished:
+            text += f"\n⏱ Vaqt: {elapsed:.0f} soniya"
+        return text
+    
+    @staticmethod
+    async def run(broadcast_id, text, cursor=0, sent=0, failed=0, blocked=0, elapsed=0.0):
+        blocked_ids = await asyncio.to_thread(db.fetch_blocked_users)
+        # Users up to cursor are already counted in the saved progress
+        remaining = sorted(user_id for user_id in users if user_id > cursor and not is_admin(user_id))
+        total = sent + failed + blocked + len(remaining)
+        progress_message = await outbound.send(
+            SendMessage(chat_id=ADMIN_ID, text=Broadcast.progress_text(sent, failed, blocked, total, elapsed)),
+            PRIORITY_ADMIN
+        )
+        
+        newly_blocked = []
+        
+        def on_error(method, error):
+            if isinstance(error, TelegramForbiddenError):  # Blocked the bot or deleted the account
+                newly_blocked.append(method.chat_id)
+                db.block_user(method.chat_id)
+            else:
+                logging.error(f"Broadcast {broadcast_id} to {method.chat_id} failed: {error}")
+        
+        for start in range(0, len(remaining), BROADCAST_BATCH_SIZE):
+            batch = remaining[start:start + BROADCAST_BATCH_SIZE]
+            recipients = [user_id for user_id in batch if user_id not in blocked_ids]
+            blocked += len(batch) - len(recipients)  # Known to have blocked the bot, not sent again
+            started = time.monotonic()
+            batch_sent, batch_failed = await fan_out(
+                (SendMessage(chat_id=user_id, text=text) for user_id in recipients),
+                PRIORITY_BROADCAST, BROADCAST_CONCURRENCY, on_error
+            )
+            elapsed += time.monotonic() - started
+            sent += batch_sent
+            blocked += len(newly_blocked)
+            failed += batch_failed - len(newly_blocked)
+            newly_blocked.clear()
+            db.save_broadcast_progress(broadcast_id, batch[-1], sent, failed, blocked, elapsed)
+            outbound.submit(EditMessageText(
+                chat_id=ADMIN_ID,
+                message_id=progress_message.message_id,
+                text=Broadcast.progress_text(sent, failed, blocked, total, elapsed)
+            ), PRIORITY_ADMIN)
+        
+        db.save_broadcast_progress(broadcast_id, remaining[-1] if remaining else cursor,
+                                   sent, failed, blocked, elapsed, status="done")
+        logging.info(f"Broadcast {broadcast_id} done: {sent} sent, {failed} failed, {blocked} blocked in {elapsed:.1f}s")
+        outbound.submit(SendMessage(
+            chat_id=ADMIN_ID,
+            text=Broadcast.progress_text(sent, failed, blocked, total, elapsed, finished=True)
+        ), PRIORITY_ADMIN)
 
 class QuizManager:
     @staticmethod
@@ -395,38 +2089,100 @@ class QuizManager:
         while code in quizzes:
             code = QuizManager.generate_quiz_code()
         quizzes[code] = quiz_data
+        quiz_misses.pop(code, None)
+        QuizManager.build_question_views(code, quiz_data)
+        db.save_quiz(code, quiz_data)
         return code
     
     @staticmethod
-    def get_quiz(code):
-        return quizzes.get(code)
+    def build_question_views(code, quiz):
+        """Prebuild message text and answer keyboard for every question of a quiz"""
+        total = len(quiz['questions'])
+        views = []
+        for i, question in enumerate(quiz['questions']):
+            text = (
+                f"📝 {i + 1}-savol {total} dan:\n"
+                f"⏳ {QUESTION_TIMEOUT} soniya\n\n"
+                f"{question['question']}"
+            )
+            keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text=f"A) {question['variants'][0]}", callback_data=f"answer_{i}_0")],
+                [InlineKeyboardButton(text=f"B) {question['variants'][1]}", callback_data=f"answer_{i}_1")],
+                [InlineKeyboardButton(text=f"C) {question['variants'][2]}", callback_data=f"answer_{i}_2")]
+            ])
+            views.append((text, keyboard))
+        question_views[code] = (quiz, views)
+        return views
+    
+    @staticmethod
+    def get_question_view(code, index):
+        """Get prebuilt (text, keyboard) for a question; rebuilt if the quiz was replaced"""
+        quiz = quizzes.get(code)
+        cached = question_views.get(code)
+        if quiz is None:
+            question_views.pop(code, None)
+            return None
+        if cached is None or cached[0] is not quiz:
+            return QuizManager.build_question_views(code, quiz)[index]
+        return cached[1][index]
+    
+    @staticmethod
+    async def get_quiz(code):
+        quiz = quizzes.get(code)
+        if quiz is not None:
+            return quiz
+        
+        expires_at = quiz_misses.get(code)
+        if expires_at is not None and expires_at > time.monotonic():
+            return None  # Looked up recently and not found, don't hit the database again
+        
+        # Another webhook worker may have created it since the last sync
+        quiz = await asyncio.to_thread(db.fetch_quiz, code)
+        if quiz is not None:
+            quizzes.setdefault(code, quiz)
+            quiz_misses.pop(code, None)
+            return quizzes[code]
+        
+        quiz_misses[code] = time.monotonic() + QUIZ_MISS_CACHE_TTL
+        quiz_misses.move_to_end(code)
+        while len(quiz_misses) > QUIZ_MISS_CACHE_MAX_SIZE:
+            quiz_misses.popitem(last=False)
+        return None
+    
+    @staticmethod
+    def index_user(user_id):
+        """Move user to their last_seen position in the user directory"""
+        last_seen = datetime.strptime(users[user_id]['last_seen'], '%Y-%m-%d %H:%M:%S')
+        user_directory.update(user_id, -last_seen.timestamp())
     
     @staticmethod
     def has_user_taken_quiz(quiz_code, user_id):
         """Check if user has already taken this quiz"""
-        if quiz_code not in quiz_results:
-            return False
-        
-        for result in quiz_results[quiz_code]:
-            if result['user_id'] == user_id:
-                return True
-        return False
+        return user_id in quiz_result_index.get(quiz_code, {})
+    
+    @staticmethod
+    def get_user_result(quiz_code, user_id):
+        """Get user's first result for this quiz, or None"""
+        return quiz_result_index.get(quiz_code, {}).get(user_id)
     
     @staticmethod
     def save_result(quiz_code, user_name, user_id, username, score, total, answers):
+        """Save an attempt; answers are FSM answer codes (variant index or ANSWER_TIMEOUT).
+        
+        A username of None is looked up in the user profile cache.
+        """
+        if username is None:
+            username = get_username(user_id)
         if quiz_code not in quiz_results:
             quiz_results[quiz_code] = []
         
-        result = {
-            'user_name': user_name,
-            'user_id': user_id,
-            'username': username,
-            'score': score,
-            'total': total,
-            'answers': answers,
-            'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        }
+        result = QuizResult(
+            user_name, user_id, username, score, total, QuizResult.pack_answers(answers), int(time.time())
+        )
         quiz_results[quiz_code].append(result)
+        quiz_result_index.setdefault(quiz_code, {}).setdefault(user_id, result)
+        results_page_cache.pop(quiz_code, None)
+        db.save_result(quiz_code, result)
         
         # Save user info
         users[user_id] = {
@@ -434,19 +2190,423 @@ class QuizManager:
             'username': username,
             'last_seen': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         }
+        QuizManager.index_user(user_id)
+        db.save_user(user_id, users[user_id])
+        
+        # Update bi-weekly ranking
+        BiWeeklyManager.update_bi_weekly_ranking(user_id, user_name, username, score, total, quiz_code)
+
+# Question analytics settings
+QUESTION_STATS_PAGE_SIZE = 15  # Questions per report page
+DISCRIMINATION_GROUP_SHARE = 0.27  # Top and bottom share of attempts compared by the discrimination index
+DISTRACTOR_MIN_SHARE = 0.05  # A wrong variant picked less often than this isn't distracting anyone
+question_group_cache = {}  # quiz_code -> (result count, group size, upper picks, lower picks)
+
+class QuestionStats:
+    """Per-question answer counters and the admin item analysis report.
+    
+    Picks per variant, correct answers, timeouts and response time sums are
+    added to the question_stats table as each answer or timeout is recorded.
+    The discrimination index compares the best and worst
+    DISCRIMINATION_GROUP_SHARE of attempts: each group's packed answers are
+    joined into one bytes array (attempts x questions) and every question is
+    a strided column slice counted in C, which keeps 100k attempts fast.
+    """
+    
+    @staticmethod
+    def record(quiz_code, question_index, selected, correct_answer, response_time=None):
+        """Count one answer (variant index) or timeout (ANSWER_TIMEOUT)"""
+        picks = [0] * len(ANSWER_LETTERS)
+        if selected == ANSWER_TIMEOUT:
+            db.add_question_stats(quiz_code, question_index, picks, 1, 0, 0.0)
+        else:
+            picks[selected] = 1
+            db.add_question_stats(
+                quiz_code, question_index, picks, 0, int(selected == correct_answer), response_time or 0.0
+            )
+    
+    @staticmethod
+    def score_groups(quiz_code, question_count):
+        """(group size, upper picks, lower picks), picks[question][variant] counted
+        over the best and worst scoring attempts"""
+        results = quiz_results.get(quiz_code, [])
+        cached = question_group_cache.get(quiz_code)
+        if cached is not None and cached[0] == len(results):
+            return cached[1:]
+        
+        attempts = sorted(
+            (result for result in results if len(result.answers) == question_count),
+            key=lambda result: result.score
+        )
+        group_size = int(len(attempts) * DISCRIMINATION_GROUP_SHARE)
+        upper = b"".join(result.answers for result in attempts[len(attempts) - group_size:])
+        lower = b"".join(result.answers for result in attempts[:group_size])
+        
+        def count_picks(matrix):
+            return [
+                [column.count(variant) for variant in range(len(ANSWER_LETTERS))]
+                for column in (matrix[question::question_count] for question in range(question_count))
+            ]
+        
+        groups = (group_size, count_picks(upper), count_picks(lower))
+        question_group_cache[quiz_code] = (len(results), *groups)
+        return groups
+    
+    @staticmethod
+    def difficulty_label(p_value):
+        if p_value >= 0.8:
+            return "oson"
+        if p_value <= 0.3:
+            return "qiyin"
+        return "o'rtacha"
+    
+    @staticmethod
+    def render_question(index, question, counters, group_size, upper_picks, lower_picks):
+        picks, timeouts, correct, response_time_sum = counters
+        seen = sum(picks) + timeouts
+        answer = question['correct_answer']
+        p_value = correct / seen
+        
+        title = question['question'] if len(question['question']) <= 60 else question['question'][:57] + "..."
+        text = f"{index + 1}. {title}\n"
+        text += f"   🎯 Qiyinlik: {p_value:.0%} to'g'ri ({QuestionStats.difficulty_label(p_value)})"
+        if group_size:
+            discrimination = (upper_picks[answer] - lower_picks[answer]) / group_size
+            text += f" | ⚖️ Ajratish: {discrimination:.2f}{' ⚠️' if discrimination < 0.2 else ''}"
+        text += "\n   "
+        
+        variants = []
+        for variant, letter in enumerate(ANSWER_LETTERS):
+            share = picks[variant] / seen
+            mark = ""
+            if variant == answer:
+                mark = " ✅"
+            elif share < DISTRACTOR_MIN_SHARE or (group_size and upper_picks[variant] > lower_picks[variant]):
+                mark = " ⚠️"  # Nobody falls for it, or it draws the strong students more than the weak
+            variants.append(f"{letter}: {share:.0%}{mark}")
+        text += " | ".join(variants)
+        text += f" | ⏰ {timeouts / seen:.0%}"
+        if sum(picks):
+            text += f" | ⏱ {response_time_sum / sum(picks):.1f} s"
+        return text + "\n\n"
+    
+    @staticmethod
+    async def get_page(quiz_code, offset):
+        """Get (text, keyboard) for one page of a quiz's question analysis"""
+        quiz = quizzes[quiz_code]
+        questions = quiz['questions']
+        offset = max(0, min(offset, (len(questions) - 1) // QUESTION_STATS_PAGE_SIZE * QUESTION_STATS_PAGE_SIZE))
+        page_end = min(offset + QUESTION_STATS_PAGE_SIZE, len(questions))
+        counters = await asyncio.to_thread(db.fetch_question_stats, quiz_code)
+        group_size, upper_picks, lower_picks = QuestionStats.score_groups(quiz_code, len(questions))
+        
+        text = f"📈 Savollar tahlili: {quiz['name']}\n"
+        text += f"👥 Natijalar: {len(quiz_results.get(quiz_code, []))}"
+        if group_size:
+            text += f" | ⚖️ Ajratish: eng yaxshi va eng past {group_size} tadan"
+        text += f"\n📄 {offset + 1}-{page_end} / {len(questions)}\n"
+        text += "⚠️ - yomon ajratuvchi savol yoki ishlamayotgan variant\n\n"
+        for index in range(offset, page_end):
+            question_counters = counters.get(index)
+            if question_counters is None or not sum(question_counters[0]) + question_counters[1]:
+                text += f"{index + 1}. Hali javoblar yo'q\n\n"
+                continue
+            text += QuestionStats.render_question(
+                index, questions[index], question_counters, group_size,
+                upper_picks[index] if group_size else None, lower_picks[index] if group_size else None
+            )
+        
+        navigation = []
+        if offset > 0:
+            navigation.append(InlineKeyboardButton(
+                text="⬅️ Oldingi", callback_data=f"quiz_stats_{quiz_code}_{offset - QUESTION_STATS_PAGE_SIZE}"
+            ))
+        if page_end < len(questions):
+            navigation.append(InlineKeyboardButton(
+                text="Keyingi ➡️", callback_data=f"quiz_stats_{quiz_code}_{page_end}"
+            ))
+        keyboard = [navigation] if navigation else []
+        keyboard.append([InlineKeyboardButton(text="🔙 Orqaga", callback_data=f"quiz_results_{quiz_code}")])
+        return text, InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+# Quiz import settings (admins can upload a whole quiz as a JSON or CSV document)
+QUIZ_IMPORT_MAX_FILE_SIZE = 5 * 1024 * 1024  # Bytes
+QUIZ_IMPORT_MAX_QUESTIONS = 200
+QUIZ_IMPORT_MAX_QUESTION_LENGTH = 3500  # Keeps a question message under Telegram's 4096 characters
+QUIZ_IMPORT_MAX_ERRORS = 15  # Errors listed in the reply
+QUIZ_IMPORT_CHUNK_SIZE = 64 * 1024
+QUIZ_IMPORT_CSV_HEADER_WORDS = ("javob", "answer", "correct", "to'g'ri")  # In the answer column of a header row
+
+class JsonChunkReader:
+    """Reads JSON values one at a time from a text file read in chunks"""
+    
+    def __init__(self, file, errors):
+        self.file = file
+        self.errors = errors
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.position = 0
+        self.line = 1
+        self.eof = False
+    
+    def read_more(self, size=None):
+        chunk = self.file.read(size or QUIZ_IMPORT_CHUNK_SIZE)
+        self.buffer, self.position, self.eof = self.buffer[self.position:] + chunk, 0, not chunk
+    
+    def peek(self):
+        """Next non-whitespace character, or None at the end of the file"""
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in " \t\r\n":
+                if self.buffer[self.position] == "\n":
+                    self.line += 1
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if self.eof:
+                return None
+            self.read_more()
+    
+    def skip(self):
+        self.position += 1
+    
+    def error(self, message):
+        self.errors.append((self.line, message))
+    
+    def decode(self):
+        """Decode the next value; returns (line, value) or None on error"""
+        if self.peek() is None:
+            self.error("JSON xatosi: qiymat kutilgan")
+            return None
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                if end < len(self.buffer) or self.eof:
+                    break
+                # A number may continue in the next chunk
+            except json.JSONDecodeError as e:
+                if self.eof or len(self.buffer) - self.position >= QUIZ_IMPORT_MAX_FILE_SIZE:
+                    self.errors.append((self.line + self.buffer.count("\n", self.position, e.pos), f"JSON xatosi: {e.msg}"))
+                    return None
+            # Grow geometrically so one large value is decoded O(log n) times, not O(n)
+            self.read_more(max(QUIZ_IMPORT_CHUNK_SIZE, len(self.buffer) - self.position))
+        line = self.line
+        self.line += self.buffer.count("\n", self.position, end)
+        self.position = end
+        return line, value
+    
+    def iter_array(self):
+        """Yield (line, value) for each element of an array whose '[' was just
+        skipped; returns True if the array was closed properly"""
+        expect_value = True
+        while True:
+            char = self.peek()
+            if char is None:
+                self.error("JSON massivi yopilmagan (']' yo'q)")
+                return False
+            if char == ']':
+                self.skip()
+                return True
+            if not expect_value:
+                if char != ',':
+                    self.error("JSON xatosi: ',' yoki ']' kutilgan")
+                    return False
+                self.skip()
+                expect_value = True
+                continue
+            decoded = self.decode()
+            if decoded is None:
+                return False
+            yield decoded
+            expect_value = False
+    
+    def iter_object(self):
+        """Read the object at the current position key by key. Elements of its
+        "questions" array are yielded as they are read, then (line, object)
+        with "questions" set to []; returns True if the object was read"""
+        line = self.line
+        self.skip()
+        value = {}
+        while True:
+            char = self.peek()
+            if char is None:
+                self.error("JSON obyekti yopilmagan ('}' yo'q)")
+                return False
+            if char == '}':
+                self.skip()
+                break
+            if value:
+                if char != ',':
+                    self.error("JSON xatosi: ',' yoki '}' kutilgan")
+                    return False
+                self.skip()
+            decoded = self.decode()
+            if decoded is None:
+                return False
+            key = decoded[1]
+            if not isinstance(key, str) or self.peek() != ':':
+                self.error("JSON xatosi: \"kalit\": qiymat kutilgan")
+                return False
+            self.skip()
+            if key == 'questions' and self.peek() == '[':
+                self.skip()
+                if not (yield from self.iter_array()):
+                    return False
+                value[key] = []
+                continue
+            decoded = self.decode()
+            if decoded is None:
+                return False
+            value[key] = decoded[1]
+        yield line, value
+        return True
+
+class QuizImporter:
+    """Stream-parse and validate quiz files.
+    
+    CSV: one question per row, "question,A,B,C,correct" (a header row is
+    skipped, see is_csv_header). JSON: an array of question objects, one object per line
+    (JSON Lines) or {"name": ..., "questions": [...]}. A question object is
+    {"question": ..., "variants": [A, B, C], "correct_answer": "A"}.
+    Correct answers are A/B/C or 1/2/3. Errors carry the file line number.
+    """
+    
+    @staticmethod
+    def parse_correct_answer(value):
+        """A/B/C or 1/2/3 -> 0-based index, None if invalid"""
+        text = str(value).strip().upper()
+        if text in ('A', '1'):
+            return 0
+        if text in ('B', '2'):
+            return 1
+        if text in ('C', '3'):
+            return 2
+        return None
+    
+    @staticmethod
+    def build_question(line, question, variants, correct_answer, errors):
+        """Validate one question, record errors and return the quiz question dict"""
+        problems = []
+        question = str(question or "").strip()
+        if not question:
+            problems.append("savol matni bo'sh")
+        elif len(question) > QUIZ_IMPORT_MAX_QUESTION_LENGTH:
+            problems.append(f"savol juda uzun ({QUIZ_IMPORT_MAX_QUESTION_LENGTH} belgidan oshmasin)")
+        if not isinstance(variants, list) or len(variants) != 3:
+            problems.append("aynan 3 ta variant bo'lishi kerak")
+            variants = []
+        variants = [str(variant if variant is not None else "").strip() for variant in variants]
+        if any(not variant for variant in variants):
+            problems.append("variant bo'sh")
+        correct = QuizImporter.parse_correct_answer(correct_answer)
+        if correct is None:
+            problems.append("to'g'ri javob A, B, C yoki 1, 2, 3 bo'lishi kerak")
+        
+        if problems:
+            errors.append((line, ", ".join(problems)))
+            return None
+        return {'question': question, 'variants': variants, 'correct_answer': correct}
+    
+    @staticmethod
+    def is_csv_header(row):
+        """A first row without a valid answer is a header if it isn't shaped like a
+        question (5 cells) or its last cell names the answer column"""
+        if QuizImporter.parse_correct_answer(row[-1]) is not None:
+            return False
+        last_cell = row[-1].strip().lower()
+        return len(row) != 5 or any(word in last_cell for word in QUIZ_IMPORT_CSV_HEADER_WORDS)
+    
+    @staticmethod
+    def iter_csv(file):
+        """Yield (line, question, variants, correct_answer) for each CSV row"""
+        reader = csv.reader(file)
+        line = 1
+        for row in reader:
+            row_line, line = line, reader.line_num + 1
+            if not any(cell.strip() for cell in row):
+                continue
+            if row_line == 1 and QuizImporter.is_csv_header(row):
+                continue
+            cells = [cell.strip() for cell in row]
+            yield row_line, cells[0], cells[1:-1] if len(cells) > 2 else [], cells[-1] if len(cells) > 1 else ""
+    
+    @staticmethod
+    def iter_json_values(file, errors):
+        """Yield (line, value) for each element of a top-level JSON array or
+        each value of a JSON Lines stream, reading the file in chunks.
+        
+        Top-level objects are read key by key, and the elements of their
+        "questions" array are yielded one at a time as they are read (with
+        "questions" left as [] in the object, which comes last).
+        """
+        reader = JsonChunkReader(file, errors)
+        if reader.peek() == '[':
+            reader.skip()
+            yield from reader.iter_array()
+            return
+        while reader.peek() is not None:
+            if reader.peek() == '{':
+                if not (yield from reader.iter_object()):
+                    return
+                continue
+            decoded = reader.decode()
+            if decoded is None:
+                return
+            yield decoded
+    
+    @staticmethod
+    def iter_json(file, errors, header):
+        """Yield (line, question, variants, correct_answer) for each JSON question"""
+        for line, value in QuizImporter.iter_json_values(file, errors):
+            if isinstance(value, dict) and 'questions' in value:
+                # Its questions were already yielded one by one
+                header.setdefault('name', value.get('name'))
+                if not isinstance(value['questions'], list):
+                    errors.append((line, "questions JSON massivi bo'lishi kerak"))
+            elif isinstance(value, dict) and 'question' not in value and 'name' in value:
+                header.setdefault('name', value['name'])
+            elif isinstance(value, dict):
+                yield line, value.get('question'), value.get('variants'), value.get('correct_answer')
+            else:
+                errors.append((line, "savol JSON obyekti bo'lishi kerak"))
+    
+    @staticmethod
+    def parse_file(path, file_type):
+        """Parse a quiz file; returns (name or None, questions, [(line, error), ...])"""
+        questions = []
+        errors = []
+        header = {}
+        try:
+            with open(path, encoding="utf-8-sig", newline="") as file:
+                if file_type == "csv":
+                    rows = QuizImporter.iter_csv(file)
+                else:
+                    rows = QuizImporter.iter_json(file, errors, header)
+                for line, question, variants, correct_answer in rows:
+                    if len(questions) >= QUIZ_IMPORT_MAX_QUESTIONS:
+                        errors.append((line, f"savollar soni {QUIZ_IMPORT_MAX_QUESTIONS} tadan oshmasligi kerak"))
+                        break
+                    question_data = QuizImporter.build_question(line, question, variants, correct_answer, errors)
+                    if question_data:
+                        questions.append(question_data)
+        except UnicodeDecodeError:
+            errors.append((0, "fayl UTF-8 kodlashda bo'lishi kerak"))
+        except csv.Error as e:
+            errors.append((0, f"CSV xatosi: {e}"))
         
-        # Update bi-weekly ranking
-        quiz_name = quizzes[quiz_code]['name']
-        BiWeeklyManager.update_bi_weekly_ranking(user_id, user_name, username, score, total, quiz_name)
+        name = header.get('name')
+        return (str(name).strip() if name else None), questions, errors
 
 # Admin keyboard
 def get_admin_keyboard():
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📝 Test yaratish", callback_data="create_quiz")],
+        [InlineKeyboardButton(text="📥 Fayldan import", callback_data="import_quiz")],
+        [InlineKeyboardButton(text="📡 Jonli test", callback_data="live_menu")],
         [InlineKeyboardButton(text="📊 Testlar natijalari", callback_data="view_results")],
         [InlineKeyboardButton(text="🏆 Ikki haftalik reyting", callback_data="bi_weekly_ranking")],
         [InlineKeyboardButton(text="📈 Reyting taqqoslash", callback_data="compare_rankings")],
         [InlineKeyboardButton(text="👥 Foydalanuvchilar", callback_data="view_users")],
+        [InlineKeyboardButton(text="📢 Xabar yuborish", callback_data="broadcast")],
         [InlineKeyboardButton(text="🗂️ Testlarim", callback_data="my_quizzes")]
     ])
     return keyboard
@@ -466,6 +2626,218 @@ def get_quiz_selection_keyboard():
     keyboard.append([InlineKeyboardButton(text="🔙 Orqaga", callback_data="back_to_menu")])
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
+# Paginated quiz results for admin
+RESULTS_PAGE_SIZE = 15  # Keeps a page well under Telegram's 4096 character limit
+results_page_cache = {}  # quiz_code -> {offset: page text}, dropped when a result is saved
+
+def render_results_page(quiz_code, offset):
+    quiz = quizzes.get(quiz_code)
+    quiz_name = quiz['name'] if quiz else quiz_code
+    results = quiz_results.get(quiz_code, [])
+    
+    if not results:
+        return f"📊 Natijalar: {quiz_name}\n\nHali hech kim test topshirmagan."
+    
+    page_end = min(offset + RESULTS_PAGE_SIZE, len(results))
+    results_text = f"📊 Natijalar: {quiz_name}\n"
+    results_text += f"📄 {offset + 1}-{page_end} / {len(results)}\n\n"
+    for i in range(offset, page_end):
+        result = results[i]
+        results_text += f"{i + 1}. {result.user_name}\n"
+        if result.username:
+            results_text += f"   @{result.username}\n"
+        else:
+            results_text += f"   Username yo'q\n"
+        results_text += f"   ID: {result.user_id}\n"
+        results_text += f"   Ball: {result.score}/{result.total}\n"
+        results_text += f"   ✅ Javob berildi: {result.answered_count}\n"
+        results_text += f"   ⏰ Vaqt tugadi: {result.timeout_count}\n"
+        results_text += f"   Sana: {result.date}\n\n"
+    return results_text
+
+def get_results_page(quiz_code, offset):
+    """Get (text, keyboard) for one page of a quiz's results"""
+    total = len(quiz_results.get(quiz_code, []))
+    offset = max(0, min(offset, (total - 1) // RESULTS_PAGE_SIZE * RESULTS_PAGE_SIZE)) if total else 0
+    
+    pages = results_page_cache.setdefault(quiz_code, {})
+    if offset not in pages:
+        pages[offset] = render_results_page(quiz_code, offset)
+    
+    navigation = []
+    if offset > 0:
+        navigation.append(InlineKeyboardButton(
+            text="⬅️ Oldingi", callback_data=f"quiz_results_{quiz_code}_{offset - RESULTS_PAGE_SIZE}"
+        ))
+    if offset + RESULTS_PAGE_SIZE < total:
+        navigation.append(InlineKeyboardButton(
+            text="Keyingi ➡️", callback_data=f"quiz_results_{quiz_code}_{offset + RESULTS_PAGE_SIZE}"
+        ))
+    keyboard = [navigation] if navigation else []
+    if total:
+        keyboard.append([InlineKeyboardButton(text="📥 CSV yuklab olish", callback_data=f"export_results_{quiz_code}")])
+    if quiz_code in quizzes:
+        keyboard.append([InlineKeyboardButton(text="📈 Savollar tahlili", callback_data=f"quiz_stats_{quiz_code}")])
+    keyboard.append([InlineKeyboardButton(text="🔙 Orqaga", callback_data="view_results")])
+    return pages[offset], InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+# CSV export for admin (rows are generated lazily and written to a temp file,
+# which aiogram streams to Telegram, so large exports don't build one big string)
+def iter_quiz_result_rows(quiz_code):
+    results = quiz_results.get(quiz_code, [])
+    yield ["#", "user_id", "name", "username", "score", "total", "percent",
+           "answered", "timeouts", "date", "answers"]
+    for i in range(len(results)):  # Results appended while exporting land in the next export
+        result = results[i]
+        percent = round(result.score / result.total * 100, 1) if result.total else 0
+        answers = "".join(
+            ANSWER_LETTERS[answer] if answer < len(ANSWER_LETTERS) else "-"
+            for answer in result.answers
+        )
+        yield [i + 1, result.user_id, result.user_name, result.username or "", result.score, result.total,
+               percent, result.answered_count, result.timeout_count, result.date, answers]
+
+def iter_ranking_rows(period, user_ids):
+    period_data = bi_weekly_rankings.get(period, {})
+    yield ["position", "user_id", "name", "username", "average_percentage", "total_score",
+           "total_questions", "quiz_count", "first_attempt", "last_attempt"]
+    for position, user_id in enumerate(user_ids, 1):
+        data = period_data.get(user_id)
+        if data is None:
+            continue
+        yield [position, user_id, data['name'], data['username'] or "", data['average_percentage'],
+               data['total_score'], data['total_questions'], data['quiz_count'],
+               data.get('first_attempt', ""), data.get('last_attempt', "")]
+
+def write_csv(path, rows):
+    # utf-8-sig so Excel shows non-ASCII names correctly
+    with open(path, "w", encoding="utf-8-sig", newline="") as file:
+        csv.writer(file).writerows(rows)
+
+async def send_csv_export(message, file_name, rows, caption):
+    """Write rows to a temp CSV file off the event loop and send it as a document"""
+    handle, path = tempfile.mkstemp(suffix=".csv")
+    os.close(handle)
+    try:
+        await asyncio.to_thread(write_csv, path, rows)
+        await message.answer_document(FSInputFile(path, filename=file_name), caption=caption)
+    finally:
+        os.remove(path)
+
+# Paginated user directory for admin
+USERS_PAGE_SIZE = 20
+
+def get_users_page(offset):
+    """Get (text, keyboard) for one page of users, most recently seen first"""
+    total = len(user_directory)
+    if not total:
+        return "👥 Hech qanday foydalanuvchi test o'tkazmagan.", InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🔙 Orqaga", callback_data="back_to_menu")]
+        ])
+    
+    offset = max(0, min(offset, (total - 1) // USERS_PAGE_SIZE * USERS_PAGE_SIZE))
+    page_user_ids = user_directory.slice(offset, offset + USERS_PAGE_SIZE)
+    
+    user_list = "👥 Ro'yxatdan o'tgan foydalanuvchilar:\n"
+    user_list += f"📄 {offset + 1}-{offset + len(page_user_ids)} / {total}\n\n"
+    for user_id in page_user_ids:
+        user_info = users[user_id]
+        username = get_username(user_id)
+        user_list += f"👤 {user_info['name']}\n"
+        if username:
+            user_list += f"📱 @{username}\n"
+        else:
+            user_list += f"📱 Username yo'q\n"
+        user_list += f"🆔 ID: {user_id}\n"
+        user_list += f"📅 Oxirgi ko'rish: {user_info['last_seen']}\n\n"
+    
+    navigation = []
+    if offset > 0:
+        navigation.append(InlineKeyboardButton(
+            text="⬅️ Oldingi", callback_data=f"view_users_{offset - USERS_PAGE_SIZE}"
+        ))
+    if offset + USERS_PAGE_SIZE < total:
+        navigation.append(InlineKeyboardButton(
+            text="Keyingi ➡️", callback_data=f"view_users_{offset + USERS_PAGE_SIZE}"
+        ))
+    keyboard = [navigation] if navigation else []
+    keyboard.append([InlineKeyboardButton(text="🔙 Orqaga", callback_data="back_to_menu")])
+    return user_list, InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+# Cached ranking texts: each view is rendered once per ranking version, so many
+# users checking /ranking after a class cost one render, not one per request
+ranking_text_cache = {}  # (view, *periods) -> (versions, rendered)
+
+def get_cached_ranking(view, periods, render):
+    """Rendered ranking view, re-rendered only when one of its periods changed"""
+    key = (view,) + tuple(periods)
+    versions = tuple(ranking_versions.get(period, 0) for period in periods)
+    cached = ranking_text_cache.get(key)
+    if cached is None or cached[0] != versions:
+        cached = ranking_text_cache[key] = (versions, render())
+    return cached[1]
+
+def render_ranking_command(period, count):
+    """/ranking text and, per listed user, where their "⭐ SIZ" line goes"""
+    ranking = BiWeeklyManager.get_top_users(count, period)
+    if not ranking:
+        return "🏆 Joriy ikki hafta reytingi\n\nHali hech kim test topshirmagan.", {}
+    
+    start_date, end_date = BiWeeklyManager.get_bi_week_dates(period)
+    ranking_text = f"🏆 Joriy ikki hafta reytingi\n"
+    ranking_text += f"📅 {start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}\n\n"
+    marks = {}
+    for i, user in enumerate(ranking, 1):
+        medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
+        ranking_text += f"{medal} {user['name']}\n"
+        ranking_text += f"   📊 {user['average_percentage']}% ({user['total_score']}/{user['total_questions']})\n"
+        ranking_text += f"   🎯 {user['quiz_count']} ta test\n"
+        marks[user['user_id']] = len(ranking_text)
+        ranking_text += "\n"
+    return ranking_text, marks
+
+def render_admin_ranking(period):
+    """Admin top 10 for the current or previous period"""
+    is_current = period == BiWeeklyManager.get_current_bi_week()
+    title = "🏆 Joriy ikki hafta reytingi" if is_current else "🏆 Oldingi ikki hafta reytingi"
+    ranking = BiWeeklyManager.get_top_users(10, period)  # Top 10
+    if not ranking:
+        empty = "Hali hech kim test topshirmagan." if is_current else "Oldingi davr uchun ma'lumot yo'q."
+        return f"{title}\n\n{empty}"
+    
+    start_date, end_date = BiWeeklyManager.get_bi_week_dates(period)
+    ranking_text = f"{title}\n"
+    ranking_text += f"📅 {start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}\n\n"
+    for i, user in enumerate(ranking, 1):
+        medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
+        ranking_text += f"{medal} {user['name']}\n"
+        if user['username']:
+            ranking_text += f"   @{user['username']}\n"
+        if is_current:
+            ranking_text += f"   📊 {user['average_percentage']}% ({user['total_score']}/{user['total_questions']})\n"
+        else:
+            ranking_text += f"   📊 {user['average_percentage']}%\n"
+        ranking_text += f"   🎯 {user['quiz_count']} ta test\n\n"
+    return ranking_text
+
+def render_compare_rankings():
+    comparison = BiWeeklyManager.compare_rankings(limit=10)  # Top 10
+    if not comparison:
+        return "📈 Ikki haftalik reyting taqqoslash\n\nTaqqoslash uchun yetarli ma'lumot yo'q."
+    
+    compare_text = f"📈 Ikki haftalik reyting taqqoslash\n\n"
+    for item in comparison:
+        user = item['user']
+        current_pos = item['current_position']
+        change = item['change']
+        
+        medal = "🥇" if current_pos == 1 else "🥈" if current_pos == 2 else "🥉" if current_pos == 3 else f"{current_pos}."
+        compare_text += f"{medal} {user['name']} {change}\n"
+        if user['username']:
+            compare_text += f"   @{user['username']}\n"
+        compare_text += f"   📊 {user['average_percentage']}% ({user['total_score']}/{user['total_questions']})\n\n"
+    return compare_text
+
 # Ranking keyboard
 def get_ranking_keyboard():
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -475,6 +2847,14 @@ def get_ranking_keyboard():
     ])
     return keyboard
 
+# Keyboard under a ranking view, with CSV export when the period has data
+def get_ranking_view_keyboard(period=None):
+    keyboard = []
+    if period:
+        keyboard.append([InlineKeyboardButton(text="📥 CSV yuklab olish", callback_data=f"export_ranking_{period}")])
+    keyboard.append([InlineKeyboardButton(text="🔙 Orqaga", callback_data="bi_weekly_ranking")])
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
 # Channel membership keyboard
 def get_channel_keyboard():
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -486,9 +2866,9 @@ def get_channel_keyboard():
 # Start command
 @dp.message(Command("start"))
 async def start_command(message: types.Message, state: FSMContext):
-    # Clear any existing state and timer
+    # Clear any existing state, session and timer
     await state.clear()
-    await QuizTimer.cancel_timer(message.from_user.id)
+    QuizSession.discard(message.from_user.id)
     
     if is_admin(message.from_user.id):
         await message.answer(
@@ -497,6 +2877,9 @@ async def start_command(message: types.Message, state: FSMContext):
             reply_markup=get_admin_keyboard()
         )
     else:
+        # Pressing Start again after blocking the bot makes the user reachable
+        db.unblock_user(message.from_user.id)
+        
         # Check channel membership for regular users
         is_member = await check_channel_membership(message.from_user.id)
         if not is_member:
@@ -525,6 +2908,8 @@ async def check_membership_callback(callback: CallbackQuery):
         await callback.answer("Siz adminsiz!", show_alert=True)
         return
     
+    # User says they just joined, so don't trust a cached "not a member"
+    invalidate_channel_membership(callback.from_user.id)
     is_member = await check_channel_membership(callback.from_user.id)
     if is_member:
         await callback.message.edit_text(
@@ -557,8 +2942,8 @@ async def quiz_command(message: types.Message, state: FSMContext):
         )
         return
     
-    # Cancel any existing timer
-    await QuizTimer.cancel_timer(message.from_user.id)
+    # Cancel any quiz in progress
+    QuizSession.discard(message.from_user.id)
     
     args = message.text.split()
     if len(args) != 2:
@@ -566,7 +2951,7 @@ async def quiz_command(message: types.Message, state: FSMContext):
         return
     
     quiz_code = args[1].upper()
-    quiz = QuizManager.get_quiz(quiz_code)
+    quiz = await QuizManager.get_quiz(quiz_code)
     
     if not quiz:
         await message.answer("❌ Test topilmadi. Iltimos, kodni tekshiring.")
@@ -575,27 +2960,24 @@ async def quiz_command(message: types.Message, state: FSMContext):
     # Check if user has already taken this quiz
     if QuizManager.has_user_taken_quiz(quiz_code, message.from_user.id):
         # Get user's previous result
-        user_result = None
-        for result in quiz_results[quiz_code]:
-            if result['user_id'] == message.from_user.id:
-                user_result = result
-                break
+        user_result = QuizManager.get_user_result(quiz_code, message.from_user.id)
         
         if user_result:
-            percentage = round((user_result['score']/user_result['total']) * 100, 1)
+            percentage = round((user_result.score/user_result.total) * 100, 1)
             await message.answer(
                 f"❌ Siz bu testni allaqachon topshirgansiz!\n\n"
                 f"🎯 Test: {quiz['name']}\n"
-                f"👤 Ism: {user_result['user_name']}\n"
-                f"📊 Sizning natijangiz: {user_result['score']}/{user_result['total']} ({percentage}%)\n"
-                f"📅 Sana: {user_result['date']}\n\n"
+                f"👤 Ism: {user_result.user_name}\n"
+                f"📊 Sizning natijangiz: {user_result.score}/{user_result.total} ({percentage}%)\n"
+                f"📅 Sana: {user_result.date}\n\n"
                 f"Har bir testni faqat bir marta topshirish mumkin!"
             )
         else:
             await message.answer("❌ Siz bu testni allaqachon topshirgansiz!")
         return
     
-    await state.update_data(quiz_code=quiz_code, quiz=quiz)
+    # Only the code goes into the session, questions are read from the shared quiz
+    await state.update_data(quiz_code=quiz_code)
     
     name_message = await message.answer(
         f"🎯 Testga xush kelibsiz: {quiz['name']}\n\n"
@@ -608,6 +2990,63 @@ async def quiz_command(message: types.Message, state: FSMContext):
     await state.update_data(name_message_id=name_message.message_id)
     await state.set_state(QuizTaking.waiting_for_name)
 
+# Join a live quiz session
+@dp.message(Command("join"))
+async def join_command(message: types.Message):
+    if is_admin(message.from_user.id):
+        await message.answer("❌ Adminlar test ololmaydi. Jonli testni menyudan boshqaring.")
+        return
+    
+    is_member = await check_channel_membership(message.from_user.id)
+    if not is_member:
+        await message.answer(
+            "❌ Botdan foydalanish uchun avval kanalga qo'shiling!\n\n"
+            f"📢 Kanal: {REQUIRED_CHANNEL}",
+            reply_markup=get_channel_keyboard()
+        )
+        return
+    
+    args = message.text.split()
+    if len(args) != 2:
+        await message.answer("❌ Iltimos, test kodini taqdim eting.\nMisol: /join ABC123")
+        return
+    
+    session = live_sessions.get(args[1].upper())
+    if session is None:
+        await message.answer("❌ Bu kod bilan jonli test topilmadi.")
+        return
+    
+    error = session.join(message.from_user)
+    if error:
+        await message.answer(error)
+        return
+    await message.answer(
+        f"✅ Jonli testga qo'shildingiz: {session.quiz['name']}\n\n"
+        f"📝 Savollar: {session.total}\n"
+        f"⏰ Har bir savol uchun {QUESTION_TIMEOUT} soniya vaqt\n\n"
+        "Test boshlanishini kuting!"
+    )
+
+# Handle live quiz answers (only for non-admin users)
+@dp.callback_query(lambda c: c.data.startswith("live_answer_") and not is_admin(c.from_user.id))
+async def handle_live_answers(callback: CallbackQuery):
+    # live_answer_<code>_<question>_<variant>
+    _, _, quiz_code, question_index, selected = callback.data.split("_")
+    question_index, selected = int(question_index), int(selected)
+    session = live_sessions.get(quiz_code)
+    
+    if session is None or not session.record_answer(callback.from_user.id, question_index, selected):
+        await callback.answer("⌛ Bu savol uchun javob qabul qilinmaydi.")
+        return
+    
+    await callback.answer("✅ Javob qabul qilindi")
+    question = session.quiz['questions'][question_index]
+    await outbound.send(callback.message.edit_text(
+        f"{session.views[question_index][0]}\n\n"
+        f"✅ Javobingiz: {ANSWER_LETTERS[selected]}) {question['variants'][selected]}\n"
+        "⏳ Keyingi savolni kuting..."
+    ), PRIORITY_QUESTION)
+
 # Handle ADMIN callbacks
 @dp.callback_query(lambda c: is_admin(c.from_user.id))
 async def handle_admin_callbacks(callback: CallbackQuery, state: FSMContext):
@@ -625,6 +3064,25 @@ async def handle_admin_callbacks(callback: CallbackQuery, state: FSMContext):
         await state.update_data(quiz_name_message_id=quiz_name_message.message_id)
         await state.set_state(QuizCreation.waiting_for_quiz_name)
     
+    elif callback.data == "import_quiz":
+        await state.clear()
+        await callback.message.edit_text(
+            "📥 Testni fayldan yuklash\n\n"
+            "JSON yoki CSV faylni shu chatga yuboring. Fayl izohi test nomi bo'ladi "
+            "(izoh bo'lmasa, fayl nomi olinadi).\n\n"
+            "📄 CSV - har bir qatorda bitta savol:\n"
+            "savol,A variant,B variant,C variant,to'g'ri javob\n\n"
+            "📄 JSON:\n"
+            '{"name": "Test nomi", "questions": [\n'
+            '  {"question": "Savol?", "variants": ["A", "B", "C"], "correct_answer": "A"}\n'
+            "]}\n\n"
+            f"To'g'ri javob: A, B, C yoki 1, 2, 3. Maksimal {QUIZ_IMPORT_MAX_QUESTIONS} ta savol, "
+            f"fayl hajmi {QUIZ_IMPORT_MAX_FILE_SIZE // 1024 // 1024} MB gacha.",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="🔙 Orqaga", callback_data="back_to_menu")]
+            ])
+        )
+    
     elif callback.data == "view_results":
         quiz_keyboard = get_quiz_selection_keyboard()
         if quiz_keyboard:
@@ -649,87 +3107,25 @@ async def handle_admin_callbacks(callback: CallbackQuery, state: FSMContext):
         )
     
     elif callback.data == "current_ranking":
-        current_ranking = BiWeeklyManager.get_current_bi_weekly_ranking()
         current_bi_week = BiWeeklyManager.get_current_bi_week()
-        
-        if current_ranking:
-            start_date, end_date = BiWeeklyManager.get_bi_week_dates(current_bi_week)
-            ranking_text = f"🏆 Joriy ikki hafta reytingi\n"
-            ranking_text += f"📅 {start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}\n\n"
-            
-            for i, user in enumerate(current_ranking[:10], 1):  # Top 10
-                medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
-                ranking_text += f"{medal} {user['name']}\n"
-                if user['username']:
-                    ranking_text += f"   @{user['username']}\n"
-                ranking_text += f"   📊 {user['average_percentage']}% ({user['total_score']}/{user['total_questions']})\n"
-                ranking_text += f"   🎯 {user['quiz_count']} ta test\n\n"
-        else:
-            ranking_text = f"🏆 Joriy ikki hafta reytingi\n\n"
-            ranking_text += "Hali hech kim test topshirmagan."
+        ranking_text = get_cached_ranking("current", (current_bi_week,), lambda: render_admin_ranking(current_bi_week))
         
         await callback.message.edit_text(
             ranking_text,
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔙 Orqaga", callback_data="bi_weekly_ranking")]
-            ])
+            reply_markup=get_ranking_view_keyboard(current_bi_week if bi_weekly_rankings.get(current_bi_week) else None)
         )
     
     elif callback.data == "previous_ranking":
-        previous_ranking = BiWeeklyManager.get_previous_bi_weekly_ranking()
-        
-        if previous_ranking:
-            current_bi_week = BiWeeklyManager.get_current_bi_week()
-            year, bw_part = current_bi_week.split('-BW')
-            year = int(year)
-            bi_week_num = int(bw_part)
-            
-            if bi_week_num > 1:
-                prev_bi_week = f"{year}-BW{bi_week_num-1:02d}"
-            else:
-                prev_bi_week = f"{year-1}-BW26"
-            
-            start_date, end_date = BiWeeklyManager.get_bi_week_dates(prev_bi_week)
-            ranking_text = f"🏆 Oldingi ikki hafta reytingi\n"
-            ranking_text += f"📅 {start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}\n\n"
-            
-            for i, user in enumerate(previous_ranking[:10], 1):  # Top 10
-                medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
-                ranking_text += f"{medal} {user['name']}\n"
-                if user['username']:
-                    ranking_text += f"   @{user['username']}\n"
-                ranking_text += f"   📊 {user['average_percentage']}%\n"
-                ranking_text += f"   🎯 {user['quiz_count']} ta test\n\n"
-        else:
-            ranking_text = f"🏆 Oldingi ikki hafta reytingi\n\n"
-            ranking_text += "Oldingi davr uchun ma'lumot yo'q."
+        prev_bi_week = BiWeeklyManager.get_previous_bi_week()
+        ranking_text = get_cached_ranking("previous", (prev_bi_week,), lambda: render_admin_ranking(prev_bi_week))
         
         await callback.message.edit_text(
             ranking_text,
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔙 Orqaga", callback_data="bi_weekly_ranking")]
-            ])
+            reply_markup=get_ranking_view_keyboard(prev_bi_week if bi_weekly_rankings.get(prev_bi_week) else None)
         )
     
     elif callback.data == "compare_rankings":
-        comparison = BiWeeklyManager.compare_rankings()
-        
-        if comparison:
-            compare_text = f"📈 Ikki haftalik reyting taqqoslash\n\n"
-            
-            for item in comparison[:10]:  # Top 10
-                user = item['user']
-                current_pos = item['current_position']
-                change = item['change']
-                
-                medal = "🥇" if current_pos == 1 else "🥈" if current_pos == 2 else "🥉" if current_pos == 3 else f"{current_pos}."
-                compare_text += f"{medal} {user['name']} {change}\n"
-                if user['username']:
-                    compare_text += f"   @{user['username']}\n"
-                compare_text += f"   📊 {user['average_percentage']}% ({user['total_score']}/{user['total_questions']})\n\n"
-        else:
-            compare_text = "📈 Ikki haftalik reyting taqqoslash\n\n"
-            compare_text += "Taqqoslash uchun yetarli ma'lumot yo'q."
+        compare_text = get_cached_ranking("compare", BiWeeklyManager.get_active_periods(), render_compare_rankings)
         
         await callback.message.edit_text(
             compare_text,
@@ -738,26 +3134,12 @@ async def handle_admin_callbacks(callback: CallbackQuery, state: FSMContext):
             ])
         )
     
-    elif callback.data == "view_users":
-        if users:
-            user_list = "👥 Ro'yxatdan o'tgan foydalanuvchilar:\n\n"
-            for user_id, user_info in users.items():
-                user_list += f"👤 {user_info['name']}\n"
-                if user_info.get('username'):
-                    user_list += f"📱 @{user_info['username']}\n"
-                else:
-                    user_list += f"📱 Username yo'q\n"
-                user_list += f"🆔 ID: {user_id}\n"
-                user_list += f"📅 Oxirgi ko'rish: {user_info['last_seen']}\n\n"
-        else:
-            user_list = "👥 Hech qanday foydalanuvchi test o'tkazmagan."
+    elif callback.data.startswith("view_users"):
+        # view_users or view_users_<offset>
+        offset = int(callback.data.split("_")[2]) if callback.data.count("_") == 2 else 0
+        user_list, keyboard = get_users_page(offset)
         
-        await callback.message.edit_text(
-            user_list,
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔙 Orqaga", callback_data="back_to_menu")]
-            ])
-        )
+        await callback.message.edit_text(user_list, reply_markup=keyboard)
     
     elif callback.data == "my_quizzes":
         if quizzes:
@@ -786,40 +3168,191 @@ async def handle_admin_callbacks(callback: CallbackQuery, state: FSMContext):
         )
     
     elif callback.data.startswith("quiz_results_"):
-        quiz_code = callback.data.replace("quiz_results_", "")
-        results = quiz_results.get(quiz_code, [])
-        quiz = quizzes.get(quiz_code)
-        
-        if results:
-            results_text = f"📊 Natijalar: {quiz['name']}\n\n"
-            for i, result in enumerate(results, 1):
-                # Calculate timeout statistics
-                timeout_count = sum(1 for answer in result['answers'] if answer.get('timeout', False))
-                answered_count = result['total'] - timeout_count
-                
-                results_text += f"{i}. {result['user_name']}\n"
-                if result.get('username'):
-                    results_text += f"   @{result['username']}\n"
-                else:
-                    results_text += f"   Username yo'q\n"
-                results_text += f"   ID: {result['user_id']}\n"
-                results_text += f"   Ball: {result['score']}/{result['total']}\n"
-                results_text += f"   ✅ Javob berildi: {answered_count}\n"
-                results_text += f"   ⏰ Vaqt tugadi: {timeout_count}\n"
-                results_text += f"   Sana: {result['date']}\n\n"
-        else:
-            results_text = f"📊 Natijalar: {quiz['name']}\n\n"
-            results_text += "Hali hech kim test topshirmagan."
+        # quiz_results_<code> or quiz_results_<code>_<offset>
+        parts = callback.data.split("_")
+        quiz_code = parts[2]
+        offset = int(parts[3]) if len(parts) > 3 else 0
+        results_text, keyboard = get_results_page(quiz_code, offset)
         
+        await callback.message.edit_text(results_text, reply_markup=keyboard)
+    
+    elif callback.data == "broadcast":
+        await state.clear()
+        if Broadcast.is_running():
+            await callback.answer("⏳ Oldingi xabar hali yuborilmoqda!", show_alert=True)
+            return
         await callback.message.edit_text(
-            results_text,
+            "📢 Barcha foydalanuvchilarga xabar\n\n"
+            f"👥 Foydalanuvchilar: {len(users)}\n\n"
+            "Yuboriladigan xabar matnini kiriting:",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔙 Orqaga", callback_data="view_results")]
+                [InlineKeyboardButton(text="🔙 Orqaga", callback_data="back_to_menu")]
             ])
         )
+        await state.set_state(BroadcastCreation.waiting_for_text)
+    
+    elif callback.data == "broadcast_send":
+        data = await state.get_data()
+        text = data.get('broadcast_text')
+        await state.clear()
+        if not text:
+            await callback.answer("❌ Xabar topilmadi, qaytadan boshlang.", show_alert=True)
+            return
+        if Broadcast.is_running():
+            await callback.answer("⏳ Oldingi xabar hali yuborilmoqda!", show_alert=True)
+            return
+        await Broadcast.begin(text)
+        await callback.message.edit_text(
+            "📢 Xabar yuborish boshlandi. Natija shu yerga yuboriladi.",
+            reply_markup=get_admin_keyboard()
+        )
+    
+    elif callback.data == "live_menu":
+        if quizzes:
+            keyboard = [
+                [InlineKeyboardButton(text=f"📡 {quiz['name']} ({code})", callback_data=f"live_open_{code}")]
+                for code, quiz in quizzes.items()
+            ]
+            text = "📡 Jonli test\n\nQaysi testni hamma uchun bir vaqtda o'tkazmoqchisiz?"
+        else:
+            keyboard = []
+            text = "📡 Jonli test\n\nHech qanday test yaratilmagan."
+        keyboard.append([InlineKeyboardButton(text="🔙 Orqaga", callback_data="back_to_menu")])
+        await callback.message.edit_text(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard))
+    
+    elif callback.data.startswith("live_"):
+        # live_open_<code>, live_start_<code> or live_stop_<code>
+        _, action, quiz_code = callback.data.split("_", 2)
+        session = live_sessions.get(quiz_code)
+        if action == "open" and session is None:
+            quiz = await QuizManager.get_quiz(quiz_code)
+            if quiz:
+                session = live_sessions[quiz_code] = LiveSession(quiz_code, quiz)
+        
+        if session is None:
+            await callback.message.edit_text(
+                "📡 Jonli test topilmadi yoki yakunlangan.",
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text="🔙 Orqaga", callback_data="live_menu")]
+                ])
+            )
+        elif action == "stop":
+            await callback.message.edit_text(
+                f"❌ Jonli test bekor qilindi: {session.quiz['name']}",
+                reply_markup=get_admin_keyboard()
+            )
+            await callback.answer()
+            await session.cancel()
+            return
+        elif action == "start" and not session.participants:
+            await callback.answer("👥 Hali hech kim qo'shilmagan.", show_alert=True)
+            return
+        else:
+            if action == "start":
+                session.task = session.task or asyncio.create_task(session.start())
+            await callback.message.edit_text(session.lobby_text(), reply_markup=session.lobby_keyboard())
+    
+    elif callback.data.startswith("quiz_stats_"):
+        # quiz_stats_<code> or quiz_stats_<code>_<offset>
+        parts = callback.data.split("_")
+        quiz_code = parts[2]
+        offset = int(parts[3]) if len(parts) > 3 else 0
+        if quiz_code not in quizzes:
+            await callback.answer("❌ Test topilmadi!", show_alert=True)
+            return
+        stats_text, keyboard = await QuestionStats.get_page(quiz_code, offset)
+        await callback.message.edit_text(stats_text, reply_markup=keyboard)
+    
+    elif callback.data.startswith("export_results_"):
+        quiz_code = callback.data[len("export_results_"):]
+        quiz = quizzes.get(quiz_code)
+        count = len(quiz_results.get(quiz_code, []))
+        await callback.answer("⏳ Fayl tayyorlanmoqda...")
+        await send_csv_export(
+            callback.message,
+            f"natijalar_{quiz_code}.csv",
+            iter_quiz_result_rows(quiz_code),
+            f"📊 {quiz['name'] if quiz else quiz_code}: {count} ta natija"
+        )
+        return
+    
+    elif callback.data.startswith("export_ranking_"):
+        period = callback.data[len("export_ranking_"):]
+        user_ids = BiWeeklyManager.get_leaderboard(period).top(len(bi_weekly_rankings.get(period, {})))
+        start_date, end_date = BiWeeklyManager.get_bi_week_dates(period)
+        await callback.answer("⏳ Fayl tayyorlanmoqda...")
+        await send_csv_export(
+            callback.message,
+            f"reyting_{period}.csv",
+            iter_ranking_rows(period, user_ids),
+            f"🏆 Reyting {start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}: {len(user_ids)} ta foydalanuvchi"
+        )
+        return
     
     await callback.answer()
 
+# Import a quiz from an uploaded JSON or CSV document (admin only)
+@dp.message(lambda m: is_admin(m.from_user.id) and m.document is not None)
+async def import_quiz_document(message: types.Message, state: FSMContext):
+    document = message.document
+    file_name = document.file_name or ""
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension == ".csv" or document.mime_type == "text/csv":
+        file_type = "csv"
+    elif extension in (".json", ".jsonl") or document.mime_type == "application/json":
+        file_type = "json"
+    else:
+        await message.answer("❌ Faqat .json yoki .csv fayl yuboring.")
+        return
+    
+    if document.file_size and document.file_size > QUIZ_IMPORT_MAX_FILE_SIZE:
+        await message.answer(f"❌ Fayl juda katta (maksimal {QUIZ_IMPORT_MAX_FILE_SIZE // 1024 // 1024} MB).")
+        return
+    
+    handle, path = tempfile.mkstemp(suffix=extension)
+    os.close(handle)
+    try:
+        await bot.download(document, destination=path)
+        name, questions, errors = await asyncio.to_thread(QuizImporter.parse_file, path, file_type)
+    except Exception as e:
+        logging.error(f"Error importing quiz file {file_name}: {e}")
+        await message.answer("❌ Faylni o'qib bo'lmadi. Qaytadan urinib ko'ring.")
+        return
+    finally:
+        os.remove(path)
+    
+    if errors:
+        error_lines = "\n".join(
+            f"• {line}-qator: {error}" if line else f"• {error}"
+            for line, error in errors[:QUIZ_IMPORT_MAX_ERRORS]
+        )
+        more = f"\n... va yana {len(errors) - QUIZ_IMPORT_MAX_ERRORS} ta xato" if len(errors) > QUIZ_IMPORT_MAX_ERRORS else ""
+        await message.answer(f"❌ Faylda xatolar topildi, test saqlanmadi:\n\n{error_lines}{more}")
+        return
+    if not questions:
+        await message.answer("❌ Faylda birorta ham savol topilmadi.")
+        return
+    
+    quiz_data = {
+        'name': (message.caption or "").strip() or name or os.path.splitext(file_name)[0] or "Test",
+        'questions': questions,
+        'created_date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'created_by': message.from_user.id
+    }
+    quiz_code = QuizManager.save_quiz(quiz_data)
+    await state.clear()
+    
+    await message.answer(
+        f"🎉 Test fayldan yuklandi!\n\n"
+        f"📝 Test: {quiz_data['name']}\n"
+        f"🔑 Kod: {quiz_code}\n"
+        f"❓ Savollar: {len(questions)}\n"
+        f"⏰ Har savol uchun: {QUESTION_TIMEOUT} soniya\n\n"
+        f"Ushbu kodni foydalanuvchilar bilan ulashing:\n"
+        f"`/quiz {quiz_code}`",
+        reply_markup=get_admin_keyboard()
+    )
+
 # Handle ADMIN quiz creation messages with reply functionality
 @dp.message(lambda m: is_admin(m.from_user.id), QuizCreation.waiting_for_quiz_name)
 async def process_quiz_name(message: types.Message, state: FSMContext):
@@ -1032,6 +3565,19 @@ async def process_correct_answer(message: types.Message, state: FSMContext):
         )
         await state.clear()
 
+@dp.message(lambda m: is_admin(m.from_user.id) and m.text is not None, BroadcastCreation.waiting_for_text)
+async def process_broadcast_text(message: types.Message, state: FSMContext):
+    await state.update_data(broadcast_text=message.text)
+    await message.answer(
+        f"📢 Xabar {len(users)} ta foydalanuvchiga yuboriladi:\n\n"
+        f"{message.text}\n\n"
+        "Yuborilsinmi?",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="✅ Yuborish", callback_data="broadcast_send")],
+            [InlineKeyboardButton(text="❌ Bekor qilish", callback_data="back_to_menu")]
+        ])
+    )
+
 # Handle USER quiz taking messages (non-admin only)
 @dp.message(lambda m: not is_admin(m.from_user.id), QuizTaking.waiting_for_name)
 async def process_user_name(message: types.Message, state: FSMContext):
@@ -1065,38 +3611,22 @@ async def process_user_name(message: types.Message, state: FSMContext):
     except:
         pass
     
-    await state.update_data(
-        user_name=name,
-        current_question=0,
-        answers=[],
-        score=0
-    )
-    
-    quiz = data['quiz']
-    question = quiz['questions'][0]
-    
-    # Create answer buttons
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=f"A) {question['variants'][0]}", callback_data="answer_0")],
-        [InlineKeyboardButton(text=f"B) {question['variants'][1]}", callback_data="answer_1")],
-        [InlineKeyboardButton(text=f"C) {question['variants'][2]}", callback_data="answer_2")]
-    ])
+    quiz = await QuizManager.get_quiz(data['quiz_code'])
+    question_text, keyboard = QuizManager.get_question_view(data['quiz_code'], 0)
     
-    sent_message = await message.answer(
+    sent_message = await outbound.send(message.answer(
         f"👋 Salom, {name}!\n\n"
         f"🎯 Test: {quiz['name']}\n\n"
-        f"📝 1-savol {len(quiz['questions'])} dan:\n"
-        f"⏳ {QUESTION_TIMEOUT} soniya\n\n"
-        f"{question['question']}",
+        f"{question_text}",
         reply_markup=keyboard
-    )
+    ), PRIORITY_QUESTION)
     
-    # Store message ID for editing later
-    await state.update_data(current_message_id=sent_message.message_id)
-    await state.set_state(QuizTaking.taking_quiz)
-    
-    # Start timer for first question
-    await QuizTimer.start_question_timer(message.from_user.id, state)
+    # Answers and timeouts are handled by the session from here on
+    await QuizSession.start(message.from_user.id, state, {
+        'quiz_code': data['quiz_code'],
+        'user_name': name,
+        'current_message_id': sent_message.message_id
+    })
 
 # Handle quiz answers (only for non-admin users)
 @dp.callback_query(lambda c: c.data.startswith("answer_") and not is_admin(c.from_user.id))
@@ -1109,133 +3639,24 @@ async def handle_quiz_answers(callback: CallbackQuery, state: FSMContext):
             f"📢 Kanal: {REQUIRED_CHANNEL}",
             reply_markup=get_channel_keyboard()
         )
+        QuizSession.discard(callback.from_user.id)
         await state.clear()
         return
     
-    # Cancel the timer since user answered
-    await QuizTimer.cancel_timer(callback.from_user.id)
-    
-    data = await state.get_data()
-    quiz = data['quiz']
-    current_question = data['current_question']
-    answers = data.get('answers', [])
-    score = data.get('score', 0)
-    
-    # Get selected answer
-    selected_answer = int(callback.data.split('_')[1])
-    correct_answer = quiz['questions'][current_question]['correct_answer']
-    
-    # Check if answer is correct
-    is_correct = selected_answer == correct_answer
-    if is_correct:
-        score += 1
-    
-    answers.append({
-        'question': quiz['questions'][current_question]['question'],
-        'selected': selected_answer,
-        'correct': correct_answer,
-        'is_correct': is_correct,
-        'timeout': False
-    })
-    
-    current_question += 1
+    session = await QuizSession.get(callback.from_user.id, state)
+    if session is None or callback.message is None or callback.message.message_id != session.message_id:
+        # Buttons of a finished quiz, or left over on an earlier quiz's message
+        await callback.answer("⌛ Bu test allaqachon tugagan.")
+        return
     
-    if current_question < len(quiz['questions']):
-        # Next question
-        question = quiz['questions'][current_question]
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text=f"A) {question['variants'][0]}", callback_data="answer_0")],
-            [InlineKeyboardButton(text=f"B) {question['variants'][1]}", callback_data="answer_1")],
-            [InlineKeyboardButton(text=f"C) {question['variants'][2]}", callback_data="answer_2")]
-        ])
-        
-        await callback.message.edit_text(
-            f"📝 {current_question + 1}-savol {len(quiz['questions'])} dan:\n"
-            f"⏳ {QUESTION_TIMEOUT} soniya\n\n"
-            f"{question['question']}",
-            reply_markup=keyboard
-        )
-        
-        await state.update_data(
-            current_question=current_question,
-            answers=answers,
-            score=score
-        )
-        
-        # Start timer for next question
-        await QuizTimer.start_question_timer(callback.from_user.id, state)
-    else:
-        # Quiz finished
-        quiz_code = data['quiz_code']
-        user_name = data['user_name']
-        total_questions = len(quiz['questions'])
-        
-        # Save result
-        QuizManager.save_result(
-            quiz_code, user_name, callback.from_user.id, 
-            callback.from_user.username,
-            score, total_questions, answers
-        )
-        
-        # Calculate statistics
-        answered_count = sum(1 for answer in answers if not answer.get('timeout', False))
-        timeout_count = total_questions - answered_count
-        percentage = round((score/total_questions) * 100, 1)
-        
-        # Show results to user
-        result_text = f"🎉 Test tugatildi!\n\n"
-        result_text += f"👤 Ism: {user_name}\n"
-        result_text += f"📊 Ball: {score}/{total_questions}\n"
-        result_text += f"📈 Foiz: {percentage}%\n"
-        result_text += f"✅ Javob berildi: {answered_count}\n"
-        result_text += f"⏰ Vaqt tugadi: {timeout_count}\n\n"
-        
-        if score == total_questions:
-            result_text += "🏆 Mukammal ball! Tabriklaymiz!"
-        elif score >= total_questions * 0.8:
-            result_text += "🎯 Ajoyib ish! Zo'r natija!"
-        elif score >= total_questions * 0.6:
-            result_text += "👍 Yaxshi ish! Davom eting!"
-        else:
-            result_text += "📚 O'qishni davom ettiring va qayta urinib ko'ring!"
-        
-        result_text += f"\n\n🏆 Ikki haftalik reytingga qo'shildi!"
-        
-        await callback.message.edit_text(result_text)
-        
-        # Send results to admin
-        current_ranking = BiWeeklyManager.get_current_bi_weekly_ranking()
-        user_position = None
-        for i, user in enumerate(current_ranking, 1):
-            if user['user_id'] == callback.from_user.id:
-                user_position = i
-                break
-        
-        admin_text = f"📊 Yangi Test Natijasi!\n\n"
-        admin_text += f"🎯 Test: {quiz['name']}\n"
-        admin_text += f"👤 Talaba: {user_name}\n"
-        if callback.from_user.username:
-            admin_text += f"📱 Username: @{callback.from_user.username}\n"
-        else:
-            admin_text += f"📱 Username yo'q\n"
-        admin_text += f"🆔 ID: {callback.from_user.id}\n"
-        admin_text += f"📊 Ball: {score}/{total_questions} ({percentage}%)\n"
-        admin_text += f"✅ Javob berildi: {answered_count}\n"
-        admin_text += f"⏰ Vaqt tugadi: {timeout_count}\n"
-        admin_text += f"📅 Sana: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
-        
-        if user_position:
-            admin_text += f"\n🏆 Ikki haftalik reytingda: {user_position}-o'rin"
-        
-        # Send to admin
-        try:
-            await bot.send_message(ADMIN_ID, admin_text)
-        except Exception as e:
-            logging.error(f"Failed to send message to admin {ADMIN_ID}: {e}")
-        
-        await state.clear()
+    # answer_<question>_<variant> (buttons sent before question numbers were added: answer_<variant>)
+    parts = callback.data.split('_')
+    question_index = int(parts[1]) if len(parts) == 3 else session.current_question
+    selected_answer = int(parts[-1])
     
+    # Stop the button spinner now; the edit with the next question may wait in the outbound queue
     await callback.answer()
+    session.post("answer", question_index, selected_answer, callback)
 
 # Ranking command for all users
 @dp.message(Command("ranking"))
@@ -1251,46 +3672,30 @@ async def ranking_command(message: types.Message):
             )
             return
     
-    current_ranking = BiWeeklyManager.get_current_bi_weekly_ranking()
     current_bi_week = BiWeeklyManager.get_current_bi_week()
     
-    if current_ranking:
-        start_date, end_date = BiWeeklyManager.get_bi_week_dates(current_bi_week)
-        ranking_text = f"🏆 Joriy ikki hafta reytingi\n"
-        ranking_text += f"📅 {start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}\n\n"
-        
-        # Show different amount based on user type
-        show_count = 20 if is_admin(message.from_user.id) else 10
-        
-        for i, user in enumerate(current_ranking[:show_count], 1):
-            medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
-            ranking_text += f"{medal} {user['name']}\n"
-            ranking_text += f"   📊 {user['average_percentage']}% ({user['total_score']}/{user['total_questions']})\n"
-            ranking_text += f"   🎯 {user['quiz_count']} ta test\n"
-            
-            # Highlight current user
-            if user['user_id'] == message.from_user.id:
-                ranking_text += "   ⭐ SIZ\n"
-            ranking_text += "\n"
+    # Show different amount based on user type
+    show_count = 20 if is_admin(message.from_user.id) else 10
+    ranking_text, marks = get_cached_ranking(
+        f"top{show_count}", (current_bi_week,), lambda: render_ranking_command(current_bi_week, show_count)
+    )
+    
+    if marks:
+        # Highlight current user
+        mark = marks.get(message.from_user.id)
+        if mark is not None:
+            ranking_text = ranking_text[:mark] + "   ⭐ SIZ\n" + ranking_text[mark:]
         
         # If user is not in top 10, show their position
-        if not is_admin(message.from_user.id):
-            user_position = None
-            user_data = None
-            for i, user in enumerate(current_ranking, 1):
-                if user['user_id'] == message.from_user.id:
-                    user_position = i
-                    user_data = user
-                    break
+        elif not is_admin(message.from_user.id):
+            user_position = BiWeeklyManager.get_user_position(message.from_user.id, current_bi_week)
             
             if user_position and user_position > 10:
+                user_data = bi_weekly_rankings[current_bi_week][message.from_user.id]
                 ranking_text += f"...\n\n"
                 ranking_text += f"{user_position}. {user_data['name']} ⭐ SIZ\n"
                 ranking_text += f"   📊 {user_data['average_percentage']}% ({user_data['total_score']}/{user_data['total_questions']})\n"
                 ranking_text += f"   🎯 {user_data['quiz_count']} ta test\n"
-    else:
-        ranking_text = f"🏆 Joriy ikki hafta reytingi\n\n"
-        ranking_text += "Hali hech kim test topshirmagan."
     
     await message.answer(ranking_text)
 
@@ -1318,6 +3723,8 @@ async def handle_admin_messages(message: types.Message, state: FSMContext):
             await message.answer("❌ Iltimos, javob variantini kiriting yoki /start bosing va qaytadan boshlang.")
         elif current_state == QuizCreation.waiting_for_correct_answer.state:
             await message.answer("❌ Iltimos, to'g'ri javobni kiriting (A, B, C) yoki /start bosing va qaytadan boshlang.")
+        elif current_state == BroadcastCreation.waiting_for_text.state:
+            await message.answer("❌ Iltimos, xabar matnini kiriting yoki /start bosing va qaytadan boshlang.")
 
 # Handle unexpected messages for regular users
 @dp.message(lambda m: not is_admin(m.from_user.id))
@@ -1336,7 +3743,7 @@ async def handle_user_messages(message: types.Message, state: FSMContext):
     
     # If user is taking quiz and sends a message, cancel timer
     if current_state == QuizTaking.taking_quiz.state:
-        await QuizTimer.cancel_timer(message.from_user.id)
+        QuizSession.discard(message.from_user.id)
         await message.answer(
             "❌ Test bekor qilindi!\n\n"
             "Qaytadan test olish uchun /quiz [CODE] buyrug'idan foydalaning."
@@ -1357,13 +3764,167 @@ async def handle_user_messages(message: types.Message, state: FSMContext):
             "Test yaratuvchisidan test kodini oling!"
         )
 
+# Webhook mode: one front process receives updates and routes them by user id
+# to worker processes, so each user's FSM state and timers stay on one worker
+def get_update_user_id(update):
+    """Find the id of the user an update belongs to (0 if there is none)"""
+    for key, event in update.items():
+        if key == 'update_id' or not isinstance(event, dict):
+            continue
+        user = event.get('from') or event.get('user')
+        if user:
+            return user['id']
+        chat = event.get('chat') or event.get('message', {}).get('chat')
+        if chat:
+            return chat['id']
+    return 0
+
+def get_update_route_id(update):
+    """Id that picks the worker for an update; live quiz updates all go to the
+    admin's worker, where live sessions run"""
+    text = (update.get('message') or {}).get('text') or ""
+    data = (update.get('callback_query') or {}).get('data') or ""
+    if text.startswith("/join") or data.startswith("live_"):
+        return ADMIN_ID
+    return get_update_user_id(update)
+
+async def sync_database_forever(is_local_user):
+    """Pull quizzes, results, users and rankings written by other workers"""
+    while True:
+        await asyncio.sleep(DATABASE_SYNC_INTERVAL)
+        try:
+            changes = await asyncio.to_thread(db.read_changes, BiWeeklyManager.get_active_periods())
+            db.apply_changes(changes, is_local_user)
+        except Exception as e:
+            logging.error(f"Database sync failed: {e}")
+
+async def run_webhook_worker(index, update_queues):
+    update_queue = update_queues[index]
+    # Workers send independently, so each only gets its share of Telegram's global limit
+    worker_rate = OUTBOUND_GLOBAL_RATE / len(update_queues)
+    outbound.global_bucket = TokenBucket(worker_rate, max(1, worker_rate))
+    LiveSession.worker_queues = update_queues
+    LiveSession.worker_index = index
+    db.load()
+    metrics_runner = await Metrics.start_server(int(METRICS_PORT) + index) if METRICS_PORT else None
+    is_local_user = lambda user_id: user_id % WEBHOOK_WORKERS == index
+    sync_task = asyncio.create_task(sync_database_forever(is_local_user))
+    await QuizSession.restore(is_local_user)
+    snapshot_task = asyncio.create_task(snapshot_sessions_forever())
+    rollover_task = asyncio.create_task(ranking_rollover_forever(archive=index == 0))  # One archiver
+    if index == ADMIN_ID % len(update_queues):  # Broadcasts run where the admin's updates go
+        await Broadcast.resume()
+    loop = asyncio.get_running_loop()
+    pending = set()
+    try:
+        while True:
+            body = await loop.run_in_executor(None, update_queue.get)
+            if body is None:
+                break
+            update = json.loads(body)
+            if 'live_result' in update:
+                # Result of one of our users from a live session on the admin's worker
+                LiveSession.save_result(*update['live_result'])
+                continue
+            task = asyncio.create_task(dp.feed_raw_update(bot, update))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+    finally:
+        sync_task.cancel()
+        rollover_task.cancel()
+        snapshot_task.cancel()
+        Broadcast.stop()
+        if pending:
+            await asyncio.wait(pending, timeout=10)
+        QuizSession.snapshot()
+        await outbound.drain(timeout=10)
+        await storage.close()
+        db.close()
+        await bot.session.close()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+
+def webhook_worker(index, update_queues):
+    logging.info(f"Webhook worker {index} started (pid {os.getpid()})")
+    try:
+        asyncio.run(run_webhook_worker(index, update_queues))
+    except KeyboardInterrupt:
+        pass
+
+async def serve_webhook(update_queues):
+    async def handle_update(request):
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        body = await request.read()
+        route_id = get_update_route_id(json.loads(body))
+        update_queues[route_id % len(update_queues)].put(body)
+        return web.Response()
+    
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_update)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+    
+    try:
+        await bot.set_webhook(
+            WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        print(f"🌐 Webhook: {WEBHOOK_URL + WEBHOOK_PATH} ({len(update_queues)} workers, port {WEBAPP_PORT})")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await bot.session.close()
+
+def run_webhook():
+    context = multiprocessing.get_context("spawn")
+    update_queues = [context.Queue() for _ in range(WEBHOOK_WORKERS)]
+    workers = [
+        context.Process(target=webhook_worker, args=(index, update_queues), name=f"webhook-worker-{index}")
+        for index in range(len(update_queues))
+    ]
+    for worker in workers:
+        worker.start()
+    
+    try:
+        asyncio.run(serve_webhook(update_queues))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for update_queue in update_queues:
+            update_queue.put(None)
+        for worker in workers:
+            worker.join(timeout=30)
+
 # Main function
 async def main():
     print("🤖 Quiz Bot with Channel Requirement, Bi-weekly Ranking and Timer starting...")
     print(f"⏰ Question timeout: {QUESTION_TIMEOUT} seconds")
     print(f"👨‍💼 Admin ID: {ADMIN_ID}")
     print(f"📢 Required Channel: {REQUIRED_CHANNEL}")
-    await dp.start_polling(bot)
+    db.load()
+    metrics_runner = await Metrics.start_server(int(METRICS_PORT)) if METRICS_PORT else None
+    rollover_task = asyncio.create_task(ranking_rollover_forever())
+    await QuizSession.restore()
+    snapshot_task = asyncio.create_task(snapshot_sessions_forever())
+    await Broadcast.resume()
+    try:
+        await dp.start_polling(bot)
+    finally:
+        rollover_task.cancel()
+        snapshot_task.cancel()
+        Broadcast.stop()
+        QuizSession.snapshot()
+        await outbound.drain(timeout=10)
+        await storage.close()
+        db.close()
+        if metrics_runner:
+            await metrics_runner.cleanup()
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    if BOT_MODE == "webhook":
+        run_webhook()
+    else:
+        asyncio.run(main())
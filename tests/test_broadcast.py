@@ -0,0 +1,86 @@
+import asyncio
+import os
+import sqlite3
+import sys
+from datetime import datetime
+
+import pytest
+from aiogram import methods, types
+from aiogram.exceptions import TelegramForbiddenError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+BLOCKED_BEFORE = {3, 8}  # Blocked the bot in an earlier broadcast
+BLOCKS_NOW = {6}  # Answers 403 to this broadcast
+
+
+@pytest.fixture
+def bot_api(tmp_path, monkeypatch):
+    """Temp database, 10 users and a fake Bot API; returns the list of sent requests"""
+    monkeypatch.setattr(main, "db", main.QuizDatabase(str(tmp_path / "bot.db")))
+    monkeypatch.setattr(main, "users", {user_id: {} for user_id in range(1, 11)})
+    monkeypatch.setattr(main, "OUTBOUND_CHAT_RATE", 1000)
+    monkeypatch.setattr(main, "OUTBOUND_CHAT_BURST", 1000)
+    monkeypatch.setattr(main, "outbound", main.OutboundQueue())
+    monkeypatch.setattr(main, "BROADCAST_BATCH_SIZE", 4)
+    monkeypatch.setattr(main.Broadcast, "task", None)
+    for user_id in BLOCKED_BEFORE:
+        main.db.block_user(user_id)
+    main.db.close()  # Flush the queued writes
+
+    sent = []
+
+    async def make_request(bot, method, timeout=None):
+        sent.append(method)
+        if method.chat_id in BLOCKS_NOW:
+            raise TelegramForbiddenError(method=method, message="Forbidden: bot was blocked by the user")
+        return types.Message(
+            message_id=len(sent), date=datetime.now(), chat=types.Chat(id=method.chat_id, type="private"),
+            text=method.text
+        )
+
+    monkeypatch.setattr(main.bot.session, "make_request", make_request)
+    yield sent
+    main.db.close()
+
+
+def broadcast_row():
+    main.db.close()  # Flush queued progress writes
+    connection = sqlite3.connect(main.db.path)
+    try:
+        return connection.execute("SELECT status, cursor, sent, failed, blocked FROM broadcasts").fetchone()
+    finally:
+        connection.close()
+
+
+def test_resumed_broadcast_counts_every_user_once(bot_api, monkeypatch):
+    save_progress = main.db.save_broadcast_progress
+
+    def stop_after_first_batch(*args, **kwargs):
+        save_progress(*args, **kwargs)
+        raise asyncio.CancelledError  # The process dies right after saving batch 1
+
+    async def scenario():
+        monkeypatch.setattr(main.db, "save_broadcast_progress", stop_after_first_batch)
+        await main.Broadcast.begin("Salom")
+        with pytest.raises(asyncio.CancelledError):
+            await main.Broadcast.task
+        assert broadcast_row() == ("running", 4, 3, 0, 1)
+
+        monkeypatch.setattr(main.db, "save_broadcast_progress", save_progress)
+        await main.Broadcast.resume()
+        await main.Broadcast.task
+        await main.outbound.drain(timeout=5)
+
+    asyncio.run(scenario())
+
+    assert broadcast_row() == ("done", 10, 7, 0, 3)
+    recipients = [m.chat_id for m in bot_api if isinstance(m, methods.SendMessage) and m.text == "Salom"]
+    assert sorted(recipients) == [1, 2, 4, 5, 6, 7, 9, 10]
+    progress = [m.text for m in bot_api if m.chat_id == main.ADMIN_ID and "yuborilmoqda" in m.text]
+    assert all("/10" in text for text in progress)
+    report = [m.text for m in bot_api if m.chat_id == main.ADMIN_ID and m.text.startswith("📢 Xabar yuborildi!")]
+    assert len(report) == 1 and "Yuborildi: 7" in report[0] and "bloklagan: 3" in report[0]
+    assert main.db.fetch_blocked_users() == BLOCKED_BEFORE | BLOCKS_NOW
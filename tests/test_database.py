@@ -0,0 +1,103 @@
+import asyncio
+import os
+import sqlite3
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+@pytest.fixture
+def memory(monkeypatch):
+    """Fresh in-memory data for the code under test"""
+    monkeypatch.setattr(main, "users", {})
+    monkeypatch.setattr(main, "user_directory", main.RankedIndex())
+    return main
+
+
+def user(name, last_seen):
+    return {'name': name, 'username': name.lower(), 'last_seen': last_seen}
+
+
+def write(database, *rows):
+    for user_id, user_info in rows:
+        database.save_user(user_id, user_info)
+    database.close()  # Flushes the write queue
+
+
+def sync(database):
+    database.apply_changes(database.read_changes([]))
+
+
+def test_users_sync_out_of_id_order_and_updates(tmp_path, memory):
+    path = str(tmp_path / "bot.db")
+    writer, reader = main.QuizDatabase(path), main.QuizDatabase(path)
+
+    write(writer, (900, user("Nine", "2026-01-01 10:00:00")))
+    sync(reader)
+    assert set(main.users) == {900}
+
+    write(writer, (500, user("Five", "2026-01-02 10:00:00")), (900, user("Nine", "2026-01-03 10:00:00")))
+    sync(reader)
+    assert set(main.users) == {500, 900}
+    assert main.users[900]['last_seen'] == "2026-01-03 10:00:00"
+    assert main.user_directory.slice(0, 2) == [900, 500]
+
+    sync(reader)  # Nothing new
+    assert reader.read_changes([])[2] == []
+
+
+def test_users_from_old_schema_are_loaded(tmp_path, memory):
+    path = str(tmp_path / "old.db")
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "CREATE TABLE users (user_id INTEGER PRIMARY KEY, name TEXT NOT NULL, username TEXT, last_seen TEXT NOT NULL)"
+    )
+    connection.execute("INSERT INTO users VALUES (7, 'Old', NULL, '2026-01-01 10:00:00')")
+    connection.commit()
+    connection.close()
+
+    database = main.QuizDatabase(path)
+    sync(database)
+    assert main.users[7]['name'] == "Old"
+
+    write(database, (3, user("New", "2026-01-02 10:00:00")))
+    sync(database)
+    assert set(main.users) == {3, 7}
+
+
+def test_unknown_quiz_codes_are_looked_up_off_the_loop_and_cached(tmp_path, monkeypatch):
+    path = str(tmp_path / "bot.db")
+    writer, reader = main.QuizDatabase(path), main.QuizDatabase(path)
+    monkeypatch.setattr(main, "db", reader)
+    monkeypatch.setattr(main, "quizzes", {})
+    monkeypatch.setattr(main, "quiz_misses", main.OrderedDict())
+
+    lookups = []
+    fetch_quiz = reader.fetch_quiz
+
+    def counting_fetch_quiz(code):
+        lookups.append(threading.current_thread() is threading.main_thread())
+        return fetch_quiz(code)
+
+    monkeypatch.setattr(reader, "fetch_quiz", counting_fetch_quiz)
+    quiz = {'title': "Test", 'questions': []}
+
+    async def scenario():
+        assert await main.QuizManager.get_quiz("ABC123") is None
+        assert await main.QuizManager.get_quiz("ABC123") is None  # Served from the miss cache
+        assert lookups == [False]
+
+        writer.save_quiz("ABC123", quiz)  # Created by another worker
+        writer.close()
+        main.quiz_misses["ABC123"] = 0  # Miss expired
+        assert await main.QuizManager.get_quiz("ABC123") == quiz
+        assert await main.QuizManager.get_quiz("ABC123") == quiz  # Now in memory
+        assert lookups == [False, False]
+        assert "ABC123" not in main.quiz_misses
+
+    asyncio.run(scenario())
@@ -0,0 +1,87 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+@pytest.fixture(params=[64 * 1024, 7], ids=["one-chunk", "tiny-chunks"])
+def chunk_size(request, monkeypatch):
+    monkeypatch.setattr(main, "QUIZ_IMPORT_CHUNK_SIZE", request.param)
+    return request.param
+
+
+def parse(tmp_path, text, file_type):
+    path = tmp_path / f"quiz.{file_type}"
+    path.write_text(text, encoding="utf-8")
+    return main.QuizImporter.parse_file(str(path), file_type)
+
+
+def question(text, correct="A"):
+    return {"question": text, "variants": ["a", "b", "c"], "correct_answer": correct}
+
+
+def test_json_document_errors_point_at_their_own_lines(tmp_path, chunk_size):
+    text = (
+        '{"name": "Fizika",\n'
+        ' "questions": [\n'
+        '  {"question": "Q1?", "variants": ["a", "b", "c"], "correct_answer": "A"},\n'
+        '  {"question": "", "variants": ["a", "b", "c"], "correct_answer": "A"},\n'
+        '  {"question": "Q3?", "variants": ["a", "b"], "correct_answer": "D"},\n'
+        '  {"question": "Q4?", "variants": ["a", "b", "c"], "correct_answer": 3}\n'
+        ']}\n'
+    )
+    name, questions, errors = parse(tmp_path, text, "json")
+    assert name == "Fizika"
+    assert [q["question"] for q in questions] == ["Q1?", "Q4?"]
+    assert questions[1]["correct_answer"] == 2
+    assert [line for line, _ in errors] == [4, 5]
+
+
+def test_json_document_name_after_questions(tmp_path, chunk_size):
+    text = json.dumps({"questions": [question("Q1?"), question("Q2?", "B")], "name": "Oxirida"}, indent=1)
+    name, questions, errors = parse(tmp_path, text, "json")
+    assert (name, len(questions), errors) == ("Oxirida", 2, [])
+
+
+def test_json_array_and_json_lines(tmp_path, chunk_size):
+    array = "[\n" + ",\n".join(json.dumps(question(f"Q{i}?")) for i in range(3)) + "\n]"
+    assert parse(tmp_path, array, "json")[1:] == ([question(f"Q{i}?") | {"correct_answer": 0} for i in range(3)], [])
+
+    lines = [json.dumps({"name": "JSONL"}), json.dumps(question("Q1?")), "[1, 2]", json.dumps(question("Q2?", "C"))]
+    name, questions, errors = parse(tmp_path, "\n".join(lines), "json")
+    assert name == "JSONL"
+    assert len(questions) == 2
+    assert errors == [(3, "savol JSON obyekti bo'lishi kerak")]
+
+
+def test_json_syntax_errors_are_reported(tmp_path, chunk_size):
+    _, questions, errors = parse(tmp_path, '{"name": "X", "questions": [\n' + json.dumps(question("Q1?")) + "\n", "json")
+    assert len(questions) == 1
+    assert errors and "yopilmagan" in errors[0][1]
+
+    _, _, errors = parse(tmp_path, '[\n{"question": "Q1?",\n "variants": ["a" "b"]}\n]', "json")
+    assert errors[0][0] == 3 and errors[0][1].startswith("JSON xatosi")
+
+
+def test_csv_header_is_skipped(tmp_path):
+    text = "savol,A variant,B variant,C variant,to'g'ri javob\nQ1?,a,b,c,B\n"
+    assert parse(tmp_path, text, "csv") == (None, [question("Q1?") | {"correct_answer": 1}], [])
+
+
+def test_csv_first_row_with_bad_answer_is_reported(tmp_path):
+    text = "Q1?,a,b,c,D\nQ2?,a,b,c,1\n"
+    _, questions, errors = parse(tmp_path, text, "csv")
+    assert [q["question"] for q in questions] == ["Q2?"]
+    assert [line for line, _ in errors] == [1]
+
+
+def test_csv_errors_carry_line_numbers(tmp_path):
+    text = 'Q1?,a,b,c,A\n\n"Q3\nqator?",a,b,c,C\nQ5?,a,,c,A\n'
+    _, questions, errors = parse(tmp_path, text, "csv")
+    assert [q["question"] for q in questions] == ["Q1?", "Q3\nqator?"]
+    assert [line for line, _ in errors] == [5]
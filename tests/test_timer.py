@@ -0,0 +1,68 @@
+import asyncio
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+def run_timers(delays, start_gaps):
+    """Schedule one timer per delay (after the matching gap) and return (delay, fired - scheduled) pairs"""
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        fired = []
+        done = asyncio.Event()
+
+        async def callback(delay, scheduled):
+            fired.append((delay, loop.time() - scheduled))
+            if len(fired) == len(delays):
+                done.set()
+
+        for index, (delay, gap) in enumerate(zip(delays, start_gaps)):
+            await asyncio.sleep(gap)
+            main.QuizTimer.schedule(f"test:{index}", delay, callback, delay, loop.time())
+        await asyncio.wait_for(done.wait(), max(delays) + sum(start_gaps) + 5)
+        return fired
+
+    return asyncio.run(scenario())
+
+
+def test_timers_never_fire_early():
+    rng = random.Random(5)
+    delays = [rng.uniform(0.05, 1.0) for _ in range(40)]
+    gaps = [rng.uniform(0, main.TIMER_TICK) for _ in range(40)]
+    for delay, elapsed in run_timers(delays, gaps):
+        assert elapsed >= delay - 0.005, f"fired {delay - elapsed:.3f}s early"
+        assert elapsed <= delay + main.TIMER_TICK + 0.1, f"fired {elapsed - delay:.3f}s late"
+
+
+def test_timer_deadline_is_not_after_fire_time():
+    async def scenario():
+        fired = asyncio.get_running_loop().create_future()
+
+        async def callback():
+            fired.set_result(main.time.time())
+
+        entry = main.QuizTimer.schedule("test:deadline", 0.3, callback)
+        return entry.deadline, await asyncio.wait_for(fired, 2)
+
+    deadline, fired_at = asyncio.run(scenario())
+    assert deadline - 0.005 <= fired_at <= deadline + main.TIMER_TICK + 0.1
+
+
+def test_cancelled_timer_does_not_fire():
+    async def scenario():
+        calls = []
+
+        async def callback():
+            calls.append(1)
+
+        main.QuizTimer.schedule("test:cancel", 0.2, callback)
+        main.QuizTimer.cancel("test:cancel")
+        await asyncio.sleep(0.6)
+        return calls
+
+    assert asyncio.run(scenario()) == []
+    assert "test:cancel" not in main.active_timers